@@ -0,0 +1,24 @@
+"""The converter, from the hass_hgl_to_yaml package in this checkout, for
+the benchmarks."""
+
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def load_converter():
+    from hass_hgl_to_yaml import compiler
+    return compiler
+
+
+class Recorder:
+    """Stands in for an AutomationWriter, keeping the automations rather
+    than emitting them."""
+
+    def __init__(self):
+        self.automations = []
+
+    def write_automation(self, automation):
+        self.automations.append(automation)
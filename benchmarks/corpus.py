@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Synthetic .hgl corpora for the benchmarks.
+
+    benchmarks/corpus.py RULES [--fanout N] [--mix when=4,time_range=1]
+
+writes RULES rules to stdout.  The same arguments (and --seed) always give
+the same corpus.
+"""
+
+import argparse
+import random
+
+# the relative frequency of each kind of rule, by default
+MIX = {'when': 40,
+       'when_mqtt': 15,
+       'when_fires': 10,
+       'when_template': 5,
+       'time_range': 15,
+       'power_control': 15}
+
+TIMES = ["7:00", "8:30am", "sunrise", "sunset", "dusk", "dawn",
+         "sunrise +00:30:00", "sunset -01:00:00", "solar_noon", "23:45"]
+
+
+def braces(i, fanout):
+    """A brace expansion with fanout alternatives, unique to rule i."""
+    return "{" + ",".join("r%da%d" % (i, j) for j in range(fanout)) + "}"
+
+
+def when(i, rnd, alts):
+    subject = ("%s_motion" % alts) if alts else ("motion_%d" % i)
+    target = "light.*_%d" % i if alts else "light.l_%d" % i
+    variant = i % 4
+    if variant == 0:
+        return "when %s is Violated for 3 minutes do turn_off(%s)" % (
+            subject, target)
+    if variant == 1:
+        return ("when %s is Violated while sensor.nighttime_dark_mode == "
+                "\"1.0\" do turn_on(%s)\n"
+                "     else Normal for %d minutes do turn_off(*)" % (
+                    subject, target, rnd.randint(1, 30)))
+    if variant == 2:
+        return ("when lock.door_%d is unlocked with *.method == \"keypad\" "
+                "and *.code_id == \"%d\" do vantage.call_task_vid(vid=%d)" % (
+                    i, rnd.randint(1, 9), i))
+    # (the data of a braced rule's action can only be strings)
+    (on, off) = ("", "") if alts else (",timeout=0,beep=1",
+                                       ",timeout=10,beep=0")
+    return ("when %s is Violated\n"
+            "    do alarm_control_panel.elkm1_alarm_display_message("
+            "alarm_control_panel.area_002,line1=\"r%d\"%s)\n"
+            "    else Normal do *(alarm_control_panel.area_002,"
+            "line1=\"r%d\"%s)" % (subject, i, on, i, off))
+
+
+def when_mqtt(i, rnd, alts):
+    if alts:
+        return "when MSG_%d_%s do script.s_%d_*" % (i, alts, i)
+    return "when MSG_%d do vantage.call_task_vid(vid=%d)" % (i, i)
+
+
+def when_fires(i, rnd, alts):
+    if alts:
+        return ("when doorbird_%s_button_%d fires\n"
+                "    do play_doorbird_media(display_%d,kitchen_max)" % (
+                    alts, i, i))
+    return "when button_%d fires do script.b_%d" % (i, i)
+
+
+def when_template(i, rnd, alts):
+    return ("when {{ states(\"sensor.t_%d\") | int > %d\n"
+            "}} do script.t_%d" % (i, rnd.randint(0, 99), i))
+
+
+def time_range(i, rnd, alts):
+    (start, end) = rnd.sample(TIMES, 2)
+    if i % 2:
+        return ("%s ... %s\n"
+                "  with cover.c_%d\n"
+                "    start when sunny:\n"
+                "      cover.close_cover\n"
+                "    end:\n"
+                "      cover.open_cover" % (start, end, i))
+    return ("from %s to %s with light.l_%d start while nighttime_dark_mode: "
+            "turn_on end: turn_off" % (start, end, i))
+
+
+def power_control(i, rnd, alts):
+    return "media_%d powered_by switch.p_%d_%s" % (i, i, alts or "a")
+
+
+KINDS = {'when': when,
+         'when_mqtt': when_mqtt,
+         'when_fires': when_fires,
+         'when_template': when_template,
+         'time_range': time_range,
+         'power_control': power_control}
+
+
+def generate(rules, fanout=2, mix=None, braced=0.5, seed=0):
+    """Yield the lines of a corpus of rules rules, mixed in the proportions
+    of mix, where a braced fraction of those that can have brace
+    expansions have fanout alternatives."""
+    rnd = random.Random(seed)
+    mix = mix or MIX
+    kinds = list(mix)
+    weights = [mix[k] for k in kinds]
+    powered = False
+    for i in range(rules):
+        if i % 50 == 0:
+            yield "TOPIC vantage/t%d\n" % (i // 50)
+        kind = rnd.choices(kinds, weights)[0]
+        alts = braces(i, fanout) if (fanout > 1 and
+                                     rnd.random() < braced) else None
+        rule = KINDS[kind](i, rnd, alts)
+        powered = powered or kind == 'power_control'
+        if i % 7 == 0 and kind != 'when_template':
+            rule = "Rule %d: %s" % (i, rule)
+        yield rule + "\n"
+        yield "\n"
+    if powered:
+        yield "* off_at 23:45\n"
+
+
+def parse_mix(text):
+    """A mix from "kind=weight,..."; the kinds left out are not used."""
+    mix = {}
+    for item in text.split(","):
+        (kind, weight) = item.split("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError("unknown rule kind " + kind)
+        mix[kind] = int(weight)
+    return mix
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("rules", type=int, help="how many rules to generate")
+    ap.add_argument("--fanout", type=int, default=2,
+                    help="alternatives in each brace expansion (default 2)")
+    ap.add_argument("--braced", type=float, default=0.5,
+                    help="fraction of the rules with brace expansions "
+                    "(default 0.5)")
+    ap.add_argument("--mix", type=parse_mix,
+                    help="relative frequencies of the kinds of rules, e.g. "
+                    "when=4,time_range=1 (default %s)" % ",".join(
+                        "%s=%d" % kv for kv in MIX.items()))
+    ap.add_argument("--seed", type=int, default=0)
+    opts = ap.parse_args()
+    for line in generate(opts.rules, opts.fanout, opts.mix, opts.braced,
+                         opts.seed):
+        print(line, end="")
+
+
+if __name__ == '__main__':
+    main()
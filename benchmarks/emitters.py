@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Per-automation cost of each of the converter's emitters.
+
+Compiles an .hgl file once, keeping the automations it generates, then
+times every emitter over all of them:
+
+    benchmarks/emitters.py rules.hgl [-r REPEAT]
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+from converter import Recorder, load_converter
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("hgl", help="the .hgl file whose automations to emit")
+    ap.add_argument("-r", "--repeat", type=int, default=5,
+                    help="time each emitter this many times (best is kept)")
+    opts = ap.parse_args()
+
+    hgl = load_converter()
+    parser = hgl.make_parser("lalr")
+    recorder = Recorder()
+    text = Path(opts.hgl).read_text()
+    outputter = hgl.HassOutputter(opts.hgl, recorder,
+                                  hgl.Source.from_text(text),
+                                  visit_tokens=True)
+    outputter.transform(hgl.parse(parser, text))
+    outputter.finish()
+    automations = recorder.automations
+    print("%d automations from %s" % (len(automations), opts.hgl))
+
+    baseline = None
+    for (name, emit) in hgl.EMITTERS.items():
+        best = None
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            size = sum(len(emit(a)) for a in automations)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        per = best / max(len(automations), 1) * 1e6
+        baseline = baseline or per
+        print("%-8s %8.1f us/automation %6.1fx %10d bytes" %
+              (name, per, baseline / per, size))
+
+
+if __name__ == '__main__':
+    main()
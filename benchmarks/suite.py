@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the converter.
+
+Times the phases of compiling synthetic corpora (see corpus.py) of
+increasing size, and their peak memory:
+
+    grammar_build   constructing the parser from the grammar
+    grammar_load    loading it from the grammar cache
+    read            mapping the corpus file, and slicing out each rule
+    parse           parsing the rules
+    transform       HassOutputter.transform of the parse trees
+    emit            writing the automations' YAML
+
+then checks that each phase scales linearly in the number of rules,
+reporting (and exiting non-zero for) any that grows faster.  The results
+go to a JSON file (-o) that a later run can --compare against:
+
+    benchmarks/suite.py -o before.json
+    ... change things ...
+    benchmarks/suite.py -o after.json --compare before.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+
+from lark import __version__ as lark_version
+from lark.exceptions import UnexpectedInput
+
+import corpus
+from converter import ROOT, Recorder, load_converter
+
+PHASES = ('read', 'parse', 'transform', 'emit')
+
+# below this, a phase's time is mostly noise and not checked for scaling
+MIN_SCALING_SECONDS = 0.005
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "-C", str(ROOT), "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(f, memory):
+    """Call f, returning its result, the seconds it took and (with memory)
+    the peak bytes it allocated."""
+    if memory:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - base if memory else None
+    return (result, elapsed, peak)
+
+
+def bench_grammar(hgl, engine, memory):
+    results = {}
+    hgl.make_parser(engine)  # so that the grammar cache is written
+    for (phase, cache) in (('grammar_build', False), ('grammar_load', True)):
+        def make():
+            return hgl.make_parser(engine, cache)
+        (_, seconds, peak) = measure(make, False)
+        if memory:
+            tracemalloc.start()
+            (_, _, peak) = measure(make, True)
+            tracemalloc.stop()
+        results[phase] = {'seconds': seconds, 'peak_bytes': peak}
+    return results
+
+
+def compile_corpus(hgl, parser, path, emitter, memory):
+    """Compile the file path the way compile_rules does, but timing
+    reading, parsing, transforming and emitting each rule separately."""
+    phases = {p: {'seconds': 0.0, 'peak_bytes': 0} for p in PHASES}
+
+    def record(phase, f):
+        (result, seconds, peak) = measure(f, memory)
+        phases[phase]['seconds'] += seconds
+        if memory:
+            phases[phase]['peak_bytes'] = max(phases[phase]['peak_bytes'],
+                                              peak)
+        return result
+
+    with open(path, "r") as f:
+        source = record('read', lambda: hgl.Source.of(f))
+    recorder = Recorder()
+    outputter = hgl.HassOutputter("bench.hgl", recorder, source,
+                                  visit_tokens=True)
+    writer = hgl.AutomationWriter(StringIO(), emitter)
+    automations = 0
+
+    def emit():
+        for a in recorder.automations:
+            writer.write_automation(a)
+        writer.take()
+
+    carry = None
+    chunks = hgl.split_rules(source)
+    while True:
+        chunk = record('read', lambda: next(chunks, None))
+        if chunk is None:
+            break
+        (line, text) = chunk
+        if carry:
+            (line, text) = (carry[0], carry[1] + text)
+            carry = None
+        try:
+            t = record('parse', lambda: hgl.parse(parser, text, line))
+        except UnexpectedInput:
+            carry = (line, text)
+            continue
+        record('transform', lambda: outputter.transform(t))
+        automations += len(recorder.automations)
+        record('emit', emit)
+        recorder.automations.clear()
+    if carry:
+        hgl.parse(parser, carry[1], carry[0])
+    record('transform', outputter.finish)
+    automations += len(recorder.automations)
+    record('emit', emit)
+    return (phases, automations)
+
+
+def bench_size(hgl, parser, rules, opts):
+    lines = 0
+    with tempfile.NamedTemporaryFile("w", suffix=".hgl",
+                                     delete=False) as f:
+        for line in corpus.generate(rules, opts.fanout, opts.mix,
+                                    opts.braced, opts.seed):
+            f.write(line)
+            lines += 1
+    try:
+        (phases, automations) = compile_corpus(hgl, parser, f.name,
+                                               opts.emitter, False)
+        if opts.memory:
+            tracemalloc.start()
+            (memory, _) = compile_corpus(hgl, parser, f.name, opts.emitter,
+                                         True)
+            tracemalloc.stop()
+    finally:
+        os.remove(f.name)
+    if opts.memory:
+        for p in PHASES:
+            phases[p]['peak_bytes'] = memory[p]['peak_bytes']
+    else:
+        for p in PHASES:
+            phases[p]['peak_bytes'] = None
+    return {'rules': rules,
+            'lines': lines,
+            'automations': automations,
+            'phases': phases,
+            'seconds': sum(phases[p]['seconds'] for p in PHASES)}
+
+
+def superlinear(sizes, threshold):
+    """The phases whose time grows faster than rules ** threshold between
+    consecutive sizes."""
+    flagged = []
+    for (a, b) in zip(sizes, sizes[1:]):
+        for p in PHASES + ('total',):
+            (ta, tb) = ((a['seconds'], b['seconds']) if p == 'total' else
+                        (a['phases'][p]['seconds'], b['phases'][p]['seconds']))
+            if ta < MIN_SCALING_SECONDS:
+                continue
+            exponent = math.log(tb / ta) / math.log(b['rules'] / a['rules'])
+            if exponent > threshold:
+                flagged.append({'phase': p, 'from': a['rules'],
+                                'to': b['rules'], 'exponent': exponent})
+    return flagged
+
+
+def kib(n):
+    return "-" if n is None else "%.0fKiB" % (n / 1024)
+
+
+def report(results):
+    for (phase, r) in results['grammar'].items():
+        print("%-14s %9.1fms %10s" % (phase, r['seconds'] * 1000,
+                                       kib(r['peak_bytes'])))
+    print()
+    print("%8s %8s %8s " % ("rules", "lines", "autos") + " ".join(
+        "%19s" % p for p in PHASES) + " %10s %10s" % ("total", "us/rule"))
+    for s in results['sizes']:
+        print("%8d %8d %8d " % (s['rules'], s['lines'], s['automations']) +
+              " ".join("%9.3fs %9s" % (s['phases'][p]['seconds'],
+                                        kib(s['phases'][p]['peak_bytes']))
+                       for p in PHASES) +
+              " %9.3fs %10.1f" % (s['seconds'],
+                                  s['seconds'] / s['rules'] * 1e6))
+    for f in results['superlinear']:
+        print("SUPER-LINEAR: %s grows as rules^%.2f from %d to %d rules" % (
+            f['phase'], f['exponent'], f['from'], f['to']))
+
+
+def compare(results, old):
+    """Print the ratio of each phase's time to that of the old results."""
+    print("\ncompared with %s:" % (old.get('commit') or "old results"))
+    before = {s['rules']: s for s in old['sizes']}
+    for s in results['sizes']:
+        o = before.get(s['rules'])
+        if o is None:
+            continue
+        print("%8d " % s['rules'] + " ".join(
+            "%s %.2fx" % (p, s['phases'][p]['seconds'] /
+                          max(o['phases'][p]['seconds'], 1e-9))
+            for p in PHASES if p in o['phases']) + " total %.2fx" % (
+                s['seconds'] / max(o['seconds'], 1e-9)))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="100,1000,10000,100000",
+                    help="comma-separated rule counts to compile "
+                    "(default 100,1000,10000,100000)")
+    ap.add_argument("--fanout", type=int, default=2,
+                    help="alternatives in each brace expansion (default 2)")
+    ap.add_argument("--braced", type=float, default=0.5,
+                    help="fraction of the rules with brace expansions "
+                    "(default 0.5)")
+    ap.add_argument("--mix", type=corpus.parse_mix,
+                    help="relative frequencies of the kinds of rules, as "
+                    "for corpus.py")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--parser", dest="engine", choices=["lalr", "earley"],
+                    default="lalr")
+    ap.add_argument("--emitter", default="fast")
+    ap.add_argument("--no-memory", dest="memory", action="store_false",
+                    help="skip the (slower) peak memory measurements")
+    ap.add_argument("--superlinear", type=float, default=1.25,
+                    help="flag a phase whose time grows faster than "
+                    "rules ** this (default 1.25)")
+    ap.add_argument("-o", "--output", help="write the results to this file")
+    ap.add_argument("--compare", help="results of an earlier run to compare "
+                    "against")
+    opts = ap.parse_args()
+
+    hgl = load_converter()
+    results = {'commit': commit(),
+               'python': platform.python_version(),
+               'lark': lark_version,
+               'parser': opts.engine,
+               'emitter': opts.emitter,
+               'fanout': opts.fanout,
+               'braced': opts.braced,
+               'mix': opts.mix or corpus.MIX,
+               'seed': opts.seed,
+               'time': time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    results['grammar'] = bench_grammar(hgl, opts.engine, opts.memory)
+    parser = hgl.make_parser(opts.engine)
+    results['sizes'] = [bench_size(hgl, parser, int(n), opts)
+                        for n in opts.sizes.split(",")]
+    results['superlinear'] = superlinear(results['sizes'], opts.superlinear)
+
+    report(results)
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(results, json.load(f))
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if results['superlinear'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""Convert .hgl rules to Home Assistant automations.
+
+    import hass_hgl_to_yaml as hgl
+
+    for automation in hgl.compile_file("rules.hgl"):
+        ...
+    hgl.render(hgl.compile_string(text, "rules.hgl"), sys.stdout)
+
+Each automation is a new dict, which the caller may change.  Importing
+this has no side effects and is cheap: the parser, lark and PyYAML are
+only loaded by the first compile.
+"""
+
+import io
+
+__all__ = ['compile_string', 'compile_file', 'render', 'configure']
+
+# the parser for each engine, built (or loaded from the grammar cache) when
+# first needed
+_parsers = {}
+
+
+def _compiler():
+    from . import compiler
+    return compiler
+
+
+def _parser(engine):
+    if engine not in _parsers:
+        _parsers[engine] = _compiler().make_parser(engine)
+    return _parsers[engine]
+
+
+def compile_string(text, source_name="string", parser="lalr"):
+    """Yield the automations (dicts) of the .hgl rules in text, as each
+    rule is converted.  The names of the automations are derived from
+    source_name, as they would be from the name of the file."""
+    return _compiler().automations(_parser(parser), source_name,
+                                   io.StringIO(text))
+
+
+def compile_file(path, parser="lalr"):
+    """Yield the automations (dicts) of the .hgl file path, as each rule is
+    read and converted."""
+    with open(path, "r") as f:
+        yield from _compiler().automations(_parser(parser), str(path), f)
+
+
+def render(automations, out=None, emitter="fast"):
+    """Write automations as the YAML of an automations file to out, or
+    return it as a string without out.  emitter is one of those of
+    --emitter: fast, libyaml, yaml or json."""
+    compiler = _compiler()
+    if compiler.MERGE_TRIGGERS:
+        automations = compiler.merge_triggers(automations)[0]
+    o = io.StringIO() if out is None else out
+    writer = compiler.AutomationWriter(o, emitter)
+    for automation in automations:
+        writer.write_automation(automation)
+    writer.flush()
+    if out is None:
+        return o.getvalue()
+
+
+def configure(base_url=None, max_expansions=None, trace=None,
+              merge_triggers=None, native_lowering=None,
+              entity_registry=None):
+    """Set the base_url of Home Assistant (used in the URLs of some
+    actions), the limit on the max_expansions of the braces of a rule, the
+    trace file (or - for stderr) to record each transform callback in,
+    whether render() should merge_triggers: combine the automations that
+    have the same trigger, whether to use native_lowering: native state
+    conditions instead of equivalent templates (the default), and the
+    entity_registry file (or Home Assistant configuration directory) to
+    check entity ids against and resolve their patterns with."""
+    _compiler().configure(base_url, max_expansions, trace, merge_triggers,
+                          native_lowering, entity_registry)
@@ -0,0 +1,3154 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+#
+# pip3 install lark-parser==0.11 #0.12 does *not* work
+# pip3 install braceexpand
+"""The grammar, the parsers and the conversion of .hgl rules to Home
+Assistant automations."""
+
+from lark import Lark, Transformer, Token, Tree, v_args
+from lark import __version__ as lark_version
+from lark.exceptions import (UnexpectedEOF, UnexpectedInput, UnexpectedToken,
+                             VisitError)
+import sys
+import os
+import atexit
+import hashlib
+import pickle
+import time
+import re
+import functools
+import itertools
+import json
+import yaml
+import collections
+import difflib
+import io
+import logging
+import pprint
+import contextlib
+import bisect
+import codecs
+import mmap
+import stat
+import fnmatch
+import tracemalloc
+from array import array
+from dataclasses import replace
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from braceexpand import braceexpand
+
+from .ir import (
+    Rule, StateTrigger, MqttTrigger, EventTrigger, TimeTrigger, SunTrigger,
+    TemplateTrigger, StateCondition, TemplateCondition, Conditions,
+    ServiceAction, Delay, Braced, EntityRef, EntityState, GroupState,
+    ConditionClause, ForClause, FromClause, ElseClause, automation_of,
+    included_automation_id, nth_automation_id, plain)
+
+# settings, which configure() changes
+HTTP_BASE_URL = "http://localhost:8123"
+MAX_EXPANSIONS = 1000
+# where each transform callback is recorded, when tracing
+TRACE = None
+# whether automations with the same trigger are merged (merge_triggers())
+MERGE_TRIGGERS = False
+# whether conditions are native ones wherever they can be, not templates
+NATIVE_LOWERING = True
+# the EntityRegistry that entity ids are checked against and resolved in
+ENTITY_REGISTRY = None
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def close_trace():
+    """Stop tracing, closing the trace file that configure() opened."""
+    global TRACE
+    if TRACE is not None and TRACE is not sys.stderr:
+        TRACE.close()
+    TRACE = None
+
+
+atexit.register(close_trace)
+
+
+def configure(base_url=None, max_expansions=None, trace=None,
+              merge_triggers=None, native_lowering=None,
+              entity_registry=None):
+    """Change the settings of this module: the base_url of Home Assistant,
+    the max_expansions of the braces of a rule, the trace file (- for
+    stderr) to append each transform callback to, whether to
+    merge_triggers of the automations of a file, whether to use
+    native_lowering of conditions and the entity_registry file (or the
+    Home Assistant configuration directory with it) to check and resolve
+    entity ids with."""
+    global HTTP_BASE_URL, MAX_EXPANSIONS, TRACE, MERGE_TRIGGERS
+    global NATIVE_LOWERING, ENTITY_REGISTRY
+    if base_url:
+        HTTP_BASE_URL = base_url
+    if max_expansions is not None:
+        MAX_EXPANSIONS = max_expansions
+    if trace:
+        close_trace()
+        TRACE = sys.stderr if trace == "-" else open(trace, "a", buffering=1)
+    if merge_triggers is not None:
+        MERGE_TRIGGERS = merge_triggers
+    if native_lowering is not None:
+        NATIVE_LOWERING = native_lowering
+    if entity_registry:
+        ENTITY_REGISTRY = EntityRegistry.load(entity_registry)
+
+
+GRAMMAR_CACHE_DIR = Path(os.environ.get(
+    "XDG_CACHE_HOME", Path.home() / ".cache")) / "hass-hgl-to-yaml"
+
+
+class Pretty:
+    """Pretty-prints a parse tree (or pformats anything else) for a log
+    message, but only if that message is actually logged."""
+    __slots__ = ('_obj',)
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __str__(self):
+        if isinstance(self._obj, Tree):
+            return self._obj.pretty()
+        return pprint.pformat(self._obj)
+
+
+def RepresentsInt(s):
+    try:
+        int(s)
+        return True
+    except ValueError:
+        return False
+
+
+# From https://gist.github.com/angstwad/bf22d1822c38a92ec0a9
+def dict_merge(dct, merge_dct):
+    """ Recursive dict merge. Inspired by :meth:``dict.update()``, instead of
+    updating only top-level keys, dict_merge recurses down into dicts nested
+    to an arbitrary depth, updating keys. The ``merge_dct`` is merged into
+    ``dct``.
+    :param dct: dict onto which the merge is executed
+    :param merge_dct: dct merged into dct
+    :return: None
+    """
+    for k, v in merge_dct.items():
+        if (k in dct and isinstance(dct[k], dict)
+                and isinstance(merge_dct[k], collections.abc.Mapping)):
+            dict_merge(dct[k], merge_dct[k])
+        else:
+            dct[k] = merge_dct[k]
+
+
+def expand_star(expansion, text):
+    return text.replace('*', expansion)
+
+
+def expand_star_dict(expansion, d):
+    answer = {}
+    for (k, v) in d.items():
+        if type(v) is dict:
+            answer[k] = expand_star_dict(expansion, v)
+        else:
+            answer[k] = expand_star(expansion, v)
+    return answer
+
+
+def expand_action(e, action):
+    """action for the expansion e of the braces of its rule."""
+    return replace(
+        action,
+        service=expand_star(e, action.service),
+        entity_id=action.entity_id and tuple(expand_star(e, i)
+                                             for i in action.entity_id),
+        data=action.data and expand_star_dict(e, action.data),
+        data_template=action.data_template and expand_star_dict(
+            e, action.data_template))
+
+
+def expand_rule(rule, e, entity_wc, name):
+    """The rule named name for the expansion e of the braces of rule, whose
+    trigger entity was entity_wc: only the trigger entity and the
+    wildcards of the action differ."""
+    entity = service_default('sensor', expand_star(e, entity_wc))
+    return replace(rule, name=name,
+                   trigger=replace(rule.trigger, entity_id=(entity,)),
+                   action=expand_action(e, rule.action))
+
+
+def uses_expansion(others):
+    for (k, v) in others.items():
+        if type(v) == str and v.find("{{") >= 0 and v.find("}}") >= 0:
+            return True
+    return False
+
+
+def media_cleanups(service):
+    service = service.replace('media_volume', 'volume')
+    service = service.replace('channel_down', 'next_track')
+    return service
+
+
+def minutes_from_time_duration(args):
+    if isinstance(args, dict):
+        (unit, val) = next(iter(args.items()))
+        val = int(val)
+        if unit == 'minutes':
+            return val
+        elif unit == 'seconds':
+            return val/60
+        elif unit == 'hours':
+            return val*60
+        else:
+            raise ValueError("Unknown unit " + unit)
+    s = [int(a) for a in args.split(":")]
+    if len(s) == 3:
+        return s[0] * 60 + s[1] + s[2]/60
+    elif len(s) == 2:
+        return s[0] + s[1]/60
+    return s[0]/60
+
+
+def offset_from_time_duration(sign, args):
+    """The offset of a sun trigger, e.g. -01:30:00, from a PLUSMINUS sign
+    and a time_duration."""
+    seconds = round(minutes_from_time_duration(args) * 60)
+    return "%s%02d:%02d:%02d" % (sign, seconds // 3600, seconds // 60 % 60,
+                                 seconds % 60)
+
+
+def text_from_meta(source, m):
+    """The text of the first line of m in source (a Source)."""
+    if m.line == m.end_line:
+        ec = m.end_column - 1
+    else:
+        ec = None
+    return source.line(m.line)[m.column-1:ec]
+
+
+# what shorten_fname() takes out of a file name
+HGL_SUFFIX = re.compile(r'(?i)\.hgl$')
+FNAME_WORD = re.compile(r'([^-])([^-]+)-?')
+
+
+def shorten_fname(fname):
+    fname = HGL_SUFFIX.sub('', fname)
+    fname = FNAME_WORD.sub(lambda m: m.group(1) + '-', fname)
+    if fname.endswith('-'):
+        fname = fname[:-1]
+    return fname
+
+
+def lines_from_meta(source_name, m):
+    """The lines of m in the file shortened to source_name (by
+    shorten_fname()), e.g. r-h:12-14."""
+    if m.line == m.end_line:
+        return "%s:%d" % (source_name, m.line)
+    return "%s:%d-%d" % (source_name, m.line, m.end_line)
+
+
+hass_grammar = r"""
+
+  start: _rule+
+
+  _rule_name: alias ":"
+
+  _rule: _rule_name? when             // .mwd
+       | _rule_name? when_state_changes
+       | _rule_name? when_mqtt
+       | _rule_name? when_fires
+       | _rule_name? when_template
+       | _rule_name? power_control    // .mpc
+       | _rule_name? time_range       // .tba
+       | _rule_name? mqtt_topic_designation
+       | include
+
+  alias: /[_0-9a-zA-Z ]+/
+
+  mqtt_topic_designation: "TOPIC" MQTT_TOPIC
+
+  MQTT_TOPIC: /[\/_0-9a-zA-Z]+/
+
+  include: "include" INCLUDE_PATH
+
+  INCLUDE_PATH: /"[^"\n]+"/
+
+  when_mqtt: "when" mqtt_message [condition_clause] "do" action
+
+  when_fires: "when" event "fires" condition_clause? "do" action
+
+  when_state_changes: "when" BRACE_EXPANDED_ENTITY "changes" "do" action
+
+  // entity_state may braceexpand into multiple separate rules
+  // entity_state's entity_id defaults to sensor._
+  // action may have '*' replacements (with media_volume->volume substitution)
+  when: "when" entity_state for_clause? condition_clause? "do" action else_clause?
+
+  when_template: "when" "{{" trigger_template "}}" condition_clause? "do" action
+
+  else_clause: "else" state_value for_clause? "do" action
+
+  mqtt_message: BRACE_EXPANDED_WORD
+
+  event: BRACE_EXPANDED_WORD
+
+  entity_state: simple_entity_state
+              | multiple_entity_state
+              | condis_entity_state
+
+  entity_state_condition: simple_entity_state
+                        | multiple_entity_state
+                        | condis_entity_state
+
+  simple_entity_state: BRACE_EXPANDED_ENTITY ("is"|"==") state_value ["from" from_attr_clause ] [ "with" with_attr_clause ] ( "and" with_attr_clause ) *
+
+  from_attr_clause: state_value
+
+  with_attr_clause: "*." ATTRIBUTE "==" state_value
+
+  ATTRIBUTE: /[_a-zA-Z][_0-9a-zA-Z]*/
+
+  multiple_entity_state: state_conjunction
+                       | state_disjunction
+
+  state_conjunction: ENTITY ("is"|"==") state_value (/and/ entity_state)+
+
+  state_disjunction: ENTITY ("is"|"==") state_value (/or/ entity_state)+
+
+  condis_entity_state: entity_disjunction "is" state_value
+                     | entity_conjunction "is" state_value
+
+  entity_disjunction: ENTITY ( "or" ENTITY )+
+
+  entity_conjunction: ENTITY ( "and" ENTITY )+
+
+  GLOBAL_STATE: "nighttime_dark_mode"
+              | "toekicks_nighttime_mode"
+              | "camect_events_enabled"
+              | "on_vacation"
+              | "babysitter_mode"
+              | "ms_between_sleep_and_morning"
+              | "sunny"
+              | "cloudy"
+              | "alarm_away"
+
+  ?state_value: RAW_VALUE
+             | "\"" DOUBLE_QUOTED_VALUE "\""
+             | "'" SINGLE_QUOTED_VALUE "'"
+
+  RAW_VALUE: /[_0-9a-zA-Z.]+/
+
+  DOUBLE_QUOTED_VALUE: /[^"\n]+/
+
+  SINGLE_QUOTED_VALUE: /[^'\n]+/
+
+  DOMAIN: /[_0-9a-zA-Z]+/
+
+  ENTITY: /([_0-9a-zA-Z\*]+\.)?[_0-9a-zA-Z]+/
+
+  BRACE_EXPANDED_ENTITY: /([_0-9a-zA-Z\*]+\.)?[{},_0-9a-zA-Z]+/
+
+  for_clause: "for" time_duration
+
+  time_duration: HH_MM_SS
+               | MM_SS
+               | NUMBER /hours/
+               | NUMBER /minutes/
+               | NUMBER /seconds/
+
+  trigger_template: JINJA_TEMPLATE
+
+  condition_clause: /(while|when)/ entity_state_condition
+                  | /(while|when)/ GLOBAL_STATE
+
+  action: _service_name
+        | _service_name "(" service_params ")"
+
+  // service_name may have '*' replacements
+  _service_name: SERVICE_NAME
+
+  // service_params may braceexpand inline (not separate rules)
+  // or '*' just backreferences the same entities mentioned in the trigger
+  service_params: /\*/
+                 | service_nvp ( "," service_nvp )*
+                 | BRACE_EXPANDED_ENTITY
+
+  service_nvp: /[_0-9a-zA-Z.\*\/]+/ ( "=" state_value ) ?
+
+  BRACE_EXPANDED_WORD: /[_0-9a-zA-Z,.{}]+/
+
+  SERVICE_NAME: /(\*|([_0-9a-zA-Z,]+\.)?[_0-9a-zA-Z,.{}]+\*?)/
+
+  JINJA_TEMPLATE: /.+/
+
+  HH_MM_SS: /[0-9]?[0-9]:[0-9][0-9]:[0-9][0-9]/
+
+  MM_SS: /[0-9]?[0-9]:[0-9][0-9]/
+
+  NUMBER: /[0-9]+(\.[0-9]+)?/
+
+  // TIME RANGE RULE (.tba)
+  time_range: "from" time "to" time with_clause start_clause end_clause
+            | time "..." time with_clause start_clause end_clause
+
+  time: TIME_LITERAL
+      | TIME_LOGICAL ( PLUSMINUS time_duration )?
+
+  TIME_LITERAL: /[0-9]?[0-9]:[0-9][0-9]([ap]m)?/
+
+  TIME_LOGICAL: "solar_noon"
+              | "sunrise" | "sunset"
+              | "dawn" | "dusk"
+              | "midnight" | "noon"
+              | "rising" | "setting"
+
+  PLUSMINUS: /[+-]/
+
+  with_clause: "with" ENTITY
+             | "with" entity_state
+
+  start_clause: "start" condition_clause ":" action
+
+  end_clause: "end" ":" action
+
+
+  // POWER RULE (.mpc)
+  // lhs does not need brace expansion
+  // rhs may be braceexpanded inline
+  power_control: ENTITY "powered_by" BRACE_EXPANDED_ENTITY
+               | /\*/ "off_at" time
+
+  COMMENT : "#" /.*/
+
+  %import common.WS
+  %ignore WS
+  %ignore COMMENT
+
+"""
+
+
+# The same language as hass_grammar, rewritten so that it is LALR(1) and
+# can be tokenized by lark's contextual lexer.  Wherever hass_grammar lets
+# ENTITY, BRACE_EXPANDED_ENTITY, BRACE_EXPANDED_WORD and GLOBAL_STATE compete
+# for the same text, this grammar uses a single SUBJECT terminal and lets the
+# parser decide from the following keyword; retype_lalr_tree() then gives
+# each SUBJECT token the type hass_grammar would have produced so that
+# HassOutputter sees the same tree from either engine.
+hass_grammar_lalr = r"""
+
+  start: _rule+
+
+  _rule_name: alias ":"
+
+  _rule: _rule_name? when
+       | _rule_name? when_state_changes
+       | _rule_name? when_mqtt
+       | _rule_name? when_fires
+       | _rule_name? when_template
+       | _rule_name? power_control
+       | _rule_name? time_range
+       | _rule_name? mqtt_topic_designation
+       | include
+
+  alias: ALIAS
+
+  // an alias is only an alias when it is followed by the ":" (and not
+  // by the minutes of a time such as "from 7:00"), and is never the "end"
+  // of a time_range
+  ALIAS.3: /(?!end\s*:)[_0-9a-zA-Z][_0-9a-zA-Z ]*(?=:(?![0-9]))/
+
+  mqtt_topic_designation: "TOPIC" MQTT_TOPIC
+
+  MQTT_TOPIC: /[\/_0-9a-zA-Z]+/
+
+  include: "include" INCLUDE_PATH
+
+  INCLUDE_PATH: /"[^"\n]+"/
+
+  when_mqtt: "when" mqtt_message [condition_clause] "do" action
+
+  when_fires: "when" event "fires" condition_clause? "do" action
+
+  when_state_changes: "when" SUBJECT "changes" "do" action
+
+  when: "when" entity_state for_clause? condition_clause? "do" action else_clause?
+
+  when_template: "when" "{{" trigger_template "}}" condition_clause? "do" action
+
+  else_clause: "else" state_value for_clause? "do" action
+
+  mqtt_message: SUBJECT
+
+  event: SUBJECT
+
+  entity_state: simple_entity_state
+              | multiple_entity_state
+              | condis_entity_state
+
+  entity_state_condition: simple_entity_state
+                        | multiple_entity_state
+                        | condis_entity_state
+
+  simple_entity_state: SUBJECT ("is"|"==") state_value ["from" from_attr_clause ] [ "with" with_attr_clause ] ( "and" with_attr_clause ) *
+
+  from_attr_clause: state_value
+
+  with_attr_clause: _STAR_DOT ATTRIBUTE "==" state_value
+
+  _STAR_DOT.2: "*."
+
+  ATTRIBUTE: /[_a-zA-Z][_0-9a-zA-Z]*/
+
+  multiple_entity_state: state_conjunction
+                       | state_disjunction
+
+  state_conjunction: SUBJECT ("is"|"==") state_value ("and" entity_state)+
+
+  state_disjunction: SUBJECT ("is"|"==") state_value ("or" entity_state)+
+
+  condis_entity_state: entity_disjunction "is" state_value
+                     | entity_conjunction "is" state_value
+
+  entity_disjunction: SUBJECT ( "or" SUBJECT )+
+
+  entity_conjunction: SUBJECT ( "and" SUBJECT )+
+
+  ?state_value: RAW_VALUE
+             | "\"" DOUBLE_QUOTED_VALUE "\""
+             | "'" SINGLE_QUOTED_VALUE "'"
+
+  RAW_VALUE: /[_0-9a-zA-Z.]+/
+
+  DOUBLE_QUOTED_VALUE: /[^"\n]+/
+
+  SINGLE_QUOTED_VALUE: /[^'\n]+/
+
+  // the union of ENTITY, BRACE_EXPANDED_ENTITY, BRACE_EXPANDED_WORD and
+  // GLOBAL_STATE; see retype_lalr_tree()
+  SUBJECT: /([_0-9a-zA-Z\*]+\.)?[{},_0-9a-zA-Z.]+/
+
+  ENTITY: /([_0-9a-zA-Z\*]+\.)?[_0-9a-zA-Z]+/
+
+  // inside "(...)" a whole-list BRACE_EXPANDED_ENTITY beats service_nvp's
+  BRACE_EXPANDED_ENTITY.2: /([_0-9a-zA-Z\*]+\.)?[{},_0-9a-zA-Z]+(?=\s*\))/
+
+  for_clause: "for" time_duration
+
+  time_duration: HH_MM_SS
+               | MM_SS
+               | NUMBER /hours/
+               | NUMBER /minutes/
+               | NUMBER /seconds/
+
+  trigger_template: JINJA_TEMPLATE
+
+  // "when" is the same keyword that starts a rule, so that the parser
+  // (rather than the lexer) decides which one it is
+  !condition_clause: ("while"|"when") entity_state_condition
+                   | ("while"|"when") SUBJECT
+
+  action: _service_name
+        | _service_name "(" service_params ")"
+
+  _service_name: SERVICE_NAME
+
+  service_params: STAR_PARAM
+                 | service_nvp ( "," service_nvp )*
+                 | BRACE_EXPANDED_ENTITY
+
+  STAR_PARAM.3: /\*(?=\s*\))/
+
+  service_nvp: /[_0-9a-zA-Z.\*\/]+/ ( "=" state_value ) ?
+
+  SERVICE_NAME: /(\*|([_0-9a-zA-Z,]+\.)?[_0-9a-zA-Z,.{}]+\*?)/
+
+  JINJA_TEMPLATE: /.+/
+
+  HH_MM_SS.3: /[0-9]?[0-9]:[0-9][0-9]:[0-9][0-9]/
+
+  MM_SS.2: /[0-9]?[0-9]:[0-9][0-9]/
+
+  NUMBER: /[0-9]+(\.[0-9]+)?/
+
+  time_range: "from" time "to" time with_clause start_clause end_clause
+            | time "..." time with_clause start_clause end_clause
+
+  time: TIME_LITERAL
+      | TIME_LOGICAL ( PLUSMINUS time_duration )?
+
+  TIME_LITERAL.2: /[0-9]?[0-9]:[0-9][0-9]([ap]m)?/
+
+  TIME_LOGICAL.2: /(solar_noon|sunrise|sunset|dawn|dusk|midnight|noon|rising|setting)(?![_0-9a-zA-Z.])/
+
+  PLUSMINUS: /[+-]/
+
+  with_clause: "with" SUBJECT
+             | "with" entity_state
+
+  start_clause: "start" condition_clause ":" action
+
+  end_clause: "end" ":" action
+
+  power_control: ENTITY "powered_by" BRACE_EXPANDED_ENTITY_RHS
+               | STAR "off_at" time
+
+  BRACE_EXPANDED_ENTITY_RHS: /([_0-9a-zA-Z\*]+\.)?[{},_0-9a-zA-Z]+/
+
+  STAR: "*"
+
+  COMMENT : "#" /.*/
+
+  %import common.WS
+  %ignore WS
+  %ignore COMMENT
+
+"""
+
+# (rule, LALR terminal) -> the hass_grammar terminal that HassOutputter
+# expects in that position
+LALR_TOKEN_TYPES = {
+    ('mqtt_message', 'SUBJECT'): 'BRACE_EXPANDED_WORD',
+    ('event', 'SUBJECT'): 'BRACE_EXPANDED_WORD',
+    ('when_state_changes', 'SUBJECT'): 'BRACE_EXPANDED_ENTITY',
+    ('simple_entity_state', 'SUBJECT'): 'BRACE_EXPANDED_ENTITY',
+    ('state_conjunction', 'SUBJECT'): 'ENTITY',
+    ('state_disjunction', 'SUBJECT'): 'ENTITY',
+    ('entity_disjunction', 'SUBJECT'): 'ENTITY',
+    ('entity_conjunction', 'SUBJECT'): 'ENTITY',
+    ('with_clause', 'SUBJECT'): 'ENTITY',
+    ('condition_clause', 'SUBJECT'): 'GLOBAL_STATE',
+    ('power_control', 'BRACE_EXPANDED_ENTITY_RHS'): 'BRACE_EXPANDED_ENTITY',
+}
+
+# the hass_grammar definitions of the terminals above; SUBJECT accepts a
+# superset of each of them, so the retyped token must still match exactly
+LALR_TOKEN_PATTERNS = {
+    'BRACE_EXPANDED_WORD': re.compile(r'[_0-9a-zA-Z,.{}]+'),
+    'BRACE_EXPANDED_ENTITY': re.compile(
+        r'([_0-9a-zA-Z\*]+\.)?[{},_0-9a-zA-Z]+'),
+    'ENTITY': re.compile(r'([_0-9a-zA-Z\*]+\.)?[_0-9a-zA-Z]+'),
+    'GLOBAL_STATE': re.compile(
+        r'nighttime_dark_mode|toekicks_nighttime_mode|camect_events_enabled'
+        r'|on_vacation|babysitter_mode|ms_between_sleep_and_morning'
+        r'|sunny|cloudy|alarm_away'),
+}
+
+
+def retype_lalr_tree(t):
+    """Give the tokens of a hass_grammar_lalr parse tree the types that
+    hass_grammar would have given them, in place.  Returns t."""
+    for st in t.iter_subtrees():
+        for (i, c) in enumerate(st.children):
+            if not isinstance(c, Token):
+                continue
+            ttype = LALR_TOKEN_TYPES.get((st.data, c.type))
+            if ttype is None:
+                continue
+            if not LALR_TOKEN_PATTERNS[ttype].fullmatch(c):
+                raise UnexpectedToken(c, {ttype})
+            st.children[i] = Token.new_borrow_pos(ttype, c, c)
+    return t
+
+
+def grammar_cache_path(grammar, options):
+    """The cache file for the parser built from grammar with options; the
+    name changes whenever the grammar, the options or lark itself do."""
+    key = hashlib.sha256((grammar + lark_version + repr(sorted(
+        options.items()))).encode('utf8')).hexdigest()[:16]
+    return GRAMMAR_CACHE_DIR / ("grammar-%s.lark" % key)
+
+
+def make_parser(engine, cache=True):
+    if engine == 'earley':
+        # lark can only cache lalr parsers
+        return Lark(hass_grammar, start="start", ambiguity="explicit",
+                    propagate_positions=True)
+    options = {'start': "start", 'parser': "lalr", 'lexer': "contextual",
+               'propagate_positions': True}
+    if cache:
+        cache_fn = grammar_cache_path(hass_grammar_lalr, options)
+        try:
+            cache_fn.parent.mkdir(parents=True, exist_ok=True)
+            options['cache'] = str(cache_fn)
+        except OSError as e:
+            _LOGGER.warning("Not caching grammar: %s", e)
+    return Lark(hass_grammar_lalr, **options)
+
+
+def parse(parser, text, first_line=1):
+    """Parse text, which starts on line first_line of its file."""
+    offset = first_line - 1
+    try:
+        t = parser.parse(text)
+    except UnexpectedInput as e:
+        if offset and getattr(e, 'line', None) is not None:
+            e.line += offset
+        raise
+    if parser.options.parser == 'lalr':
+        retype_lalr_tree(t)
+    if offset:
+        for st in t.iter_subtrees():
+            if not st.meta.empty:
+                st.meta.line += offset
+                st.meta.end_line += offset
+    return t
+
+
+def ended_early(e):
+    """Whether the parse error e is at the end of the text parsed, which
+    then holds less than a whole rule (and not a rule in error)."""
+    return isinstance(e, UnexpectedEOF) or (
+        isinstance(e, UnexpectedToken) and e.token.type == '$END')
+
+
+def replace_action_wildcards_from(else_service, service):
+    if else_service == '*':
+        return service
+    if '*.' in else_service:
+        return service + else_service[2:]
+    return else_service
+
+
+YAML_WIDTH = 240
+
+
+def emit_yaml(automation):
+    return yaml.dump([automation], sort_keys=False, width=YAML_WIDTH) + "\n"
+
+
+YAML_CDUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def emit_libyaml(automation):
+    """Same output as emit_yaml, from the libyaml C dumper when PyYAML was
+    built with it."""
+    return yaml.dump([automation], Dumper=YAML_CDUMPER, sort_keys=False,
+                     width=YAML_WIDTH) + "\n"
+
+
+class NotFast(Exception):
+    """A value outside of the shapes that emit_fast handles."""
+
+
+YAML_RESOLVER = yaml.resolver.Resolver()
+YAML_STR_TAG = 'tag:yaml.org,2002:str'
+PRINTABLE_ASCII = re.compile(r'[ -~]*$')
+# what keeps a printable ASCII string from being a plain YAML scalar
+NOT_PLAIN = re.compile(r"""^(?:[-?:](?: |$)|[,\[\]{}#&*!|>'"%@`]|---|\.\.\.)"""
+                       r"|: |:$| #|^ | $")
+
+
+@functools.lru_cache(maxsize=4096, typed=True)
+def fast_scalar(value):
+    """value as yaml.dump writes it in block style: plain when that reads
+    back as the same string, else single-quoted."""
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if value is None:
+        return 'null'
+    if type(value) is int:
+        return str(value)
+    if type(value) is not str or not PRINTABLE_ASCII.match(value):
+        raise NotFast
+    if (not NOT_PLAIN.search(value) and YAML_RESOLVER.resolve(
+            yaml.ScalarNode, value, (True, False)) == YAML_STR_TAG):
+        return value
+    return "'" + value.replace("'", "''") + "'"
+
+
+def fast_mapping(d, indent, lead, lines):
+    """Append the lines of the mapping d, its keys at column indent, to
+    lines; the first line starts with lead rather than the indent."""
+    for (k, v) in d.items():
+        if not k or type(k) is not str:
+            raise NotFast
+        if v and type(v) is dict:
+            lines.append(lead + fast_scalar(k) + ":")
+            fast_mapping(v, indent + 2, " " * (indent + 2), lines)
+        elif v and type(v) is list:
+            lines.append(lead + fast_scalar(k) + ":")
+            fast_sequence(v, indent, lines)
+        elif v == {} or v == []:
+            lines.append(lead + fast_scalar(k) + ": " + repr(v))
+        else:
+            lines.append(lead + fast_scalar(k) + ": " + fast_scalar(v))
+        lead = " " * indent
+
+
+def fast_sequence(seq, indent, lines):
+    # yaml.dump does not indent a sequence that is a mapping's value
+    lead = " " * indent + "- "
+    for v in seq:
+        if v and type(v) is dict:
+            fast_mapping(v, indent + 2, lead, lines)
+        elif v == {} or v == []:
+            lines.append(lead + repr(v))
+        elif type(v) in (dict, list):
+            raise NotFast
+        else:
+            lines.append(lead + fast_scalar(v))
+
+
+def emit_fast(automation):
+    """Same output as emit_yaml, written directly for the mappings of
+    strings, ints, bools, lists and mappings that make up an automation;
+    anything else (or a line yaml.dump would fold) goes to emit_libyaml."""
+    lines = []
+    try:
+        fast_mapping(automation, 2, "- ", lines)
+    except NotFast:
+        return emit_libyaml(automation)
+    if any(len(line) > YAML_WIDTH for line in lines):
+        return emit_libyaml(automation)
+    lines.append("\n")
+    return "\n".join(lines)
+
+
+def emit_json(automation):
+    """Each automation as a JSON object on one line, which Home Assistant
+    reads as a YAML flow mapping."""
+    return "- " + json.dumps(automation) + "\n"
+
+
+EMITTERS = {'yaml': emit_yaml,
+            'libyaml': emit_libyaml,
+            'fast': emit_fast,
+            'json': emit_json}
+
+
+# the characters an AutomationWriter buffers before writing them to a file
+WRITER_BUFSIZE = 1 << 16
+
+
+def writer_bufsize(out):
+    """The bufsize of an AutomationWriter to out: WRITER_BUFSIZE for a
+    file (or any out without a file descriptor, such as a StringIO), but
+    none for a pipe or terminal, so that whatever reads it sees each rule
+    as soon as it is converted."""
+    try:
+        if not stat.S_ISREG(os.fstat(out.fileno()).st_mode):
+            return 0
+    except (AttributeError, OSError, ValueError):
+        pass
+    return WRITER_BUFSIZE
+
+
+class AutomationWriter:
+    """Emits automations with one of the EMITTERS into a buffer that is
+    written to out whenever it reaches bufsize characters (and on flush),
+    by default as writer_bufsize() chooses for out.  With out None, the
+    text is kept until take() instead."""
+
+    def __init__(self, out, emitter='fast', bufsize=None, profile=None):
+        self._out = out
+        self._emit = EMITTERS[emitter]
+        if profile:
+            self._emit = profile.timed('emit', self._emit)
+        self._bufsize = writer_bufsize(out) if bufsize is None else bufsize
+        self._chunks = []
+        self._size = 0
+        self.written = 0
+        self.automations = 0
+
+    def write(self, text):
+        self._chunks.append(text)
+        self._size += len(text)
+        self.written += len(text)
+        if self._out is not None and self._size >= self._bufsize:
+            self.flush()
+
+    def write_automation(self, automation):
+        self.automations += 1
+        self.write(self._emit(automation))
+
+    def take(self):
+        text = "".join(self._chunks)
+        self._chunks = []
+        self._size = 0
+        return text
+
+    def flush(self):
+        self._out.write(self.take())
+        self._out.flush()
+
+
+class AutomationList(list):
+    """Collects automations, as dicts, in place of an AutomationWriter."""
+
+    def write_automation(self, automation):
+        self.append(automation)
+
+    def take(self):
+        automations = self[:]
+        self.clear()
+        return automations
+
+
+def output_comment():
+    pass
+
+
+def template_from_condis(connector, vals, is_val):
+    answer = "{{"
+    jc = " " + connector + " "
+    answer += jc.join("is_state(\"%s\", \"%s\")" % (v, is_val) for v in vals)
+    answer += "}}"
+    return answer
+
+
+def all_in_state(entities, trigger):
+    """A condition that every one of entities is in the state the state
+    trigger goes to (and has been for as long as it requires)."""
+    return Conditions('and', tuple(
+        StateCondition((e,), trigger.to, for_=trigger.for_)
+        for e in entities))
+
+
+def conditions_of(connector, conditions):
+    """One condition, for all (connector 'and') or any ('or') of the
+    conditions."""
+    if len(conditions) == 1:
+        return conditions[0]
+    return Conditions(connector, tuple(conditions))
+
+
+# the entity and its states that a GLOBAL_STATE means, for those that are
+# not a switch.X that is true
+GLOBAL_STATES = {
+    'sunny': ('sensor.weather_conditions', ('Clear', 'Partly Cloudy')),
+    'cloudy': ('sensor.weather_conditions', ('Cloudy', 'Rainy')),
+    'alarm_away': ('alarm_control_panel.area_002',
+                   ('armed_away', 'armed_vacation'))}
+
+
+def add_condition(condition, added):
+    """condition (None, a condition or a tuple of conditions, all of which
+    must hold) with added, first."""
+    if condition is None:
+        return added
+    return (added,) + (condition if isinstance(condition, tuple)
+                       else (condition,))
+
+
+def service_default(default, service):
+    if '.' in service:
+        return service
+    if not default:
+        default = 'homeassistant'
+    return default + "." + service
+
+
+def service_defaults(default, entities):
+    return tuple(service_default(default, e) for e in entities)
+
+
+def domain_from(entity):
+    if entity is False:
+        return False
+    if "." in entity:
+        return entity.split('.')[0]
+    return None
+
+
+def in_service_domain(action):
+    """action with the domain of its service given to those of its entity
+    ids that have none."""
+    domain = domain_from(action.service)
+    if not domain or not action.entity_id:
+        return action
+    return replace(action, entity_id=tuple(
+        e if '.' in e else domain + "." + e for e in action.entity_id))
+
+
+def with_defaults(action):
+    """action with the domain of its service given to its entity ids, or
+    with the homeassistant domain given to its service if that has none."""
+    if domain_from(action.service):
+        return in_service_domain(action)
+    return replace(action, service=service_default(None, action.service))
+
+
+def attributes_condition(state):
+    """The condition that the attributes of the with clauses of state (an
+    EntityState) have their values, or None if it has none."""
+    if not state.attributes:
+        return None
+    if NATIVE_LOWERING:
+        # the attributes compared as strings, as the template did
+        entity = service_defaults('sensor', state.entity.entity_id)
+        return conditions_of('and', [StateCondition(entity, str(v), str(a))
+                                     for (a, v) in state.attributes])
+    return TemplateCondition("{{ " + " and ".join(
+        "states.%s.attributes[\"%s\"] == \"%s\"" % (
+            ",".join(state.entity.entity_id), a, v)
+        for (a, v) in state.attributes) + " }}")
+
+
+# the MQTT topic of the messages of a file before any TOPIC designation
+DEFAULT_MQTT_TOPIC = 'vantage/misc'
+
+# the events of a sun trigger, by the TIME_LOGICAL they happen at; the
+# others (dawn, dusk, noon and midnight) need a template trigger
+SUN_TRIGGER_EVENTS = {'rising': 'sunrise', 'setting': 'sunset'}
+
+
+# the braces of a word, as in light.hall_{left,right}
+BRACES = re.compile(r'\{.*\}')
+
+
+class HassOutputter(Transformer):
+
+    # all of the state of a compile lives on the instance (not the class)
+    # so that several files can be compiled in the same process
+    def __init__(self, infile, out, source=None, modules=None,
+                 including=(), **kwargs):
+        self._infile = infile
+        # the prefix of the names of automations, and of their locations
+        self._source_name = shorten_fname(infile)
+        self._out = out
+        self._source = source
+        # the ModuleStore of the files that include rules name, and the
+        # files including this one (for detecting a cycle)
+        self._modules = modules
+        self._including = including + (infile,)
+        # the (path, digest) of each file included, however indirectly
+        self.included = []
+        self.mqtt_topic = DEFAULT_MQTT_TOPIC
+        # the topic of the last TOPIC designation, even of an included file
+        self.designated_topic = None
+        self.all_power_entities = []
+        # (powered_by, media_zone, name) of each power_control rule, for
+        # finish()
+        self.powered_devices = []
+        self.last_alias = None
+        # where a template had to stand in for a sun trigger
+        self.template_times = []
+        # the entity ids not in the ENTITY_REGISTRY, and where
+        self.unknown_entities = []
+        # the content id, its ordinal among those with the same content id
+        # and the alias of each automation written, and how many there are
+        # of each content id, to tell identical automations apart
+        self.automation_ids = []
+        self.id_counts = collections.Counter()
+        if TRACE is not None:
+            # untraced compiles don't pay for the wrapper
+            self._call_userfunc = self._traced_call_userfunc
+        super().__init__(kwargs)
+
+    def write_rule(self, rule):
+        """Write the automation of rule to the output, with the patterns of
+        its entity ids resolved and its unknown entity ids recorded, given
+        an ENTITY_REGISTRY."""
+        automation = automation_of(rule)
+        if ENTITY_REGISTRY is not None:
+            try:
+                (automation, unknown) = ENTITY_REGISTRY.resolve(automation)
+            except ValueError as e:
+                raise ValueError("%s: %s: %s" % (
+                    self._infile, automation['alias'], e)) from None
+            self.unknown_entities.extend(
+                "%s (%s)" % (e, automation['alias'])
+                for e in dict.fromkeys(unknown))
+        self.write_automation(automation)
+
+    def write_automation(self, automation):
+        """Write automation to the output, with an id of its own if an
+        automation written before it has the same content id."""
+        id = automation['id']
+        n = self.id_counts[id]
+        if n:
+            automation = dict(automation, id=nth_automation_id(id, n))
+        self.add_ids([(id, n, automation['alias'])])
+        self._out.write_automation(automation)
+
+    def add_ids(self, ids):
+        """Record ids, the automation_ids of automations written."""
+        self.automation_ids.extend(ids)
+        for (id, _, _) in ids:
+            self.id_counts[id] += 1
+
+    def ids_current(self, ids):
+        """Whether ids, the automation_ids of a rule compiled before, would
+        be the same if it were written now, after the automations written
+        since: whether the first of each content id has the same
+        ordinal."""
+        first = {}
+        for (id, n, _) in ids:
+            first.setdefault(id, n)
+        return all(self.id_counts[id] == n for (id, n) in first.items())
+
+    def _traced_call_userfunc(self, tree, new_children=None):
+        written = getattr(self._out, 'written', 0)
+        result = Transformer._call_userfunc(self, tree, new_children)
+        location = None
+        if not tree.meta.empty:
+            location = lines_from_meta(self._source_name, tree.meta)
+        TRACE.write(json.dumps({'callback': tree.data,
+                                'location': location,
+                                'output_chars': getattr(self._out, 'written',
+                                                        0) - written})
+                    + "\n")
+        return result
+
+    def expansions(self, exp, t):
+        """Enumerate exp, the expansions of the braces of the rule t, as
+        they are needed, failing if there are more than MAX_EXPANSIONS."""
+        for (i, e) in enumerate(exp):
+            if i == MAX_EXPANSIONS:
+                raise ValueError(
+                    "%s:%d: braces expand to more than %d rules "
+                    "(see --max-expansions)" % (self._infile, t.meta.line,
+                                                MAX_EXPANSIONS))
+            yield (i, e)
+
+    def mqtt_topic_designation(self, args):
+        _LOGGER.debug("mqtt_topic_designation: %s", args[0])
+        self.mqtt_topic = self.designated_topic = str(args[0])
+
+    @v_args(tree=True)
+    def include(self, t):
+        """Write the automations of the included file, compiled as a
+        module, and take on its TOPIC and power_control devices, as if its
+        rules were here.  Its automations get ids of their own in each file
+        including it (see included_automation_id())."""
+        name = module_name(self._infile, t.children[0][1:-1])
+        _LOGGER.debug("include: %s", name)
+        path = os.path.abspath(name)
+        if any(os.path.abspath(f) == path for f in self._including):
+            raise ValueError("%s:%d: include cycle: %s" % (
+                self._infile, t.meta.line,
+                " -> ".join(self._including + (name,))))
+        if self._modules is None:
+            raise ValueError("%s:%d: cannot include %s here" % (
+                self._infile, t.meta.line, name))
+        try:
+            module = self._modules.get(name, self._including)
+        except (OSError, UnexpectedInput) as e:
+            raise ValueError("%s:%d: cannot include %s: %s" % (
+                self._infile, t.meta.line, name, e)) from e
+        including = os.path.relpath(self._infile, os.path.dirname(path))
+        for automation in module['automations']:
+            automation = plain(automation)
+            automation['id'] = included_automation_id(automation['id'],
+                                                      including)
+            self.write_automation(automation)
+        if module['mqtt_topic'] is not None:
+            self.mqtt_topic = self.designated_topic = module['mqtt_topic']
+        self.all_power_entities.extend(module['power_added'])
+        self.powered_devices.extend(module['powered_devices'])
+        self.template_times.extend(module['template_times'])
+        self.unknown_entities.extend(module['unknown_entities'])
+        self.included.extend(module['included'])
+
+    @v_args(tree=True)
+    def when_mqtt(self, t):
+        args = t.children
+        # when_mqtt: "when" mqtt_message condition_clause? "do" action
+        _LOGGER.debug("when_mqtt: %s", Pretty(args))
+        message = args[0]
+        action = args[-1]
+        trigger = MqttTrigger(self.mqtt_topic)
+        for (i, e) in self.expansions(message.expansions or [''], t):
+            exp_msg = expand_star(e, message.word)
+            name = exp_msg + '_' + lines_from_meta(self._source_name,
+                                                   t.meta)
+            (alias, self.last_alias) = (self.last_alias, None)
+            if alias:
+                name = "wmqtt_" + alias
+            condition = TemplateCondition(
+                "{{ trigger.payload | trim == \"%s\" }}" % exp_msg)
+            self.write_rule(Rule(name, trigger, condition, with_defaults(
+                replace(action, service=media_cleanups(
+                    expand_star(e, action.service)))), alias))
+
+    @v_args(tree=True)
+    def when_fires(self, t):
+        args = t.children
+        # when_fires: "when" event "fires" condition_clause? "do" action
+        _LOGGER.debug("when_fires: %s", Pretty(args))
+        event = args[0]
+        condition = None
+        if isinstance(args[1], ConditionClause):
+            condition = args[1].condition
+        action = args[-1]
+        if isinstance(action, ServiceAction):
+            action = in_service_domain(replace(
+                action, service=service_default(None, action.service)))
+        if not event.expansions:
+            name = "wfires_" + event.word + '_' + lines_from_meta(
+                self._source_name, t.meta)
+            (alias, self.last_alias) = (self.last_alias, None)
+            if alias:
+                name = "wfires_" + alias
+            self.write_rule(Rule(name, EventTrigger(event.word), condition,
+                                 action, alias))
+        else:
+            for (i, e) in self.expansions(event.expansions, t):
+                name = "wfires_" + e + '_' + lines_from_meta(
+                    self._source_name, t.meta)
+                (alias, self.last_alias) = (self.last_alias, None)
+                if alias:
+                    name = "wfires_" + alias
+                play = action[0]
+                dt = play.data_template
+                play = replace(play, data_template={
+                    **dt, 'media_content_id': expand_star(
+                        e, dt['media_content_id'])})
+                self.write_rule(Rule(
+                    name + " #" + str(i),
+                    EventTrigger(expand_star(e, event.word)), condition,
+                    (play,) + action[1:], alias))
+
+    def when_template(self, args):
+        output_comment()
+        _LOGGER.debug("when_template: %s", args)
+
+    @v_args(inline=True)
+    def alias(self, args):
+        _LOGGER.debug("alias: %s", args)
+        self.last_alias = str(args)
+
+    @v_args(tree=True)
+    def when_state_changes(self, t):
+        args = t.children
+        _LOGGER.debug("when - TREE: %s", Pretty(t))
+        _LOGGER.debug("when: %s", args)
+        name = "when_" + lines_from_meta(self._source_name, t.meta)
+        (alias, self.last_alias) = (self.last_alias, None)
+        if alias:
+            name = "when_" + alias
+        entity = args[0]
+        rule = Rule(name, StateTrigger(entity.entity_id), None,
+                    with_defaults(args[1]), alias)
+        if not entity.expansions:
+            self.write_rule(rule)
+            return
+        for (i, e) in self.expansions(entity.expansions, t):
+            self.write_rule(expand_rule(rule, e, entity.wildcard,
+                                        name + " #" + str(i)))
+
+    @v_args(tree=True)
+    def when(self, t):
+        args = t.children
+        _LOGGER.debug("when - TREE: %s", Pretty(t))
+        _LOGGER.debug("when: %s", args)
+        name = "when_" + lines_from_meta(self._source_name, t.meta)
+        (alias, self.last_alias) = (self.last_alias, None)
+        if alias:
+            name = "when_" + alias
+        state = args[0]
+        else_clause = args[-1] if isinstance(args[-1], ElseClause) else None
+        action = with_defaults(args[-2] if else_clause else args[-1])
+        clause = next((a for a in args if isinstance(a, ConditionClause)),
+                      None)
+        if isinstance(state, GroupState):
+            # a state trigger on any of the entities reaching the state,
+            # which for 'and' is conditional on all of them being in it
+            # (and for 'or' makes the else clause conditional on all of
+            # them being in its state)
+            (entity, condis) = (None, state)
+            trigger = StateTrigger(state.entity_id, state.state)
+            condition = None
+        else:
+            (entity, condis) = (state.entity, None)
+            trigger = StateTrigger(
+                service_defaults('sensor', entity.entity_id), state.to,
+                state.from_)
+            condition = attributes_condition(state)
+        for_clause = next((a for a in args if isinstance(a, ForClause)),
+                          None)
+        if for_clause:
+            trigger = replace(trigger, for_=for_clause.duration)
+        if clause:
+            condition = clause.condition
+        # if there was an else clause, we need to copy the first rule,
+        # invert the trigger (possibly using demorgan's law) and
+        # substitute wild cards
+        else_rule = None
+        if else_clause:
+            else_trigger = replace(
+                trigger, to=else_clause.state,
+                for_=else_clause.for_ or trigger.for_)
+            # 'while' means apply the condition to the else clause, too
+            # 'when' means only have the condition on the primary
+            else_condition = condition
+            if clause and clause.keyword == 'when':
+                else_condition = None
+            else_action = else_clause.action
+            else_action = replace(else_action, service=service_default(
+                None, replace_action_wildcards_from(else_action.service,
+                                                    action.service)))
+            if else_action.entity_id == ('*',):
+                else_action = replace(else_action, entity_id=action.entity_id)
+            if condis and condis.connector == 'or':
+                # not (a or b is X) is (a and b is Y)
+                else_condition = add_condition(
+                    else_condition, all_in_state(condis.entity_id,
+                                                 else_trigger))
+            else_rule = Rule("ELSE " + name, else_trigger, else_condition,
+                             else_action, alias)
+        if condis and condis.connector == 'and':
+            condition = add_condition(condition, all_in_state(
+                condis.entity_id, trigger))
+        rule = Rule(name, trigger, condition, action, alias)
+        if not (entity and entity.expansions):
+            self.write_rule(rule)
+            if else_rule:
+                self.write_rule(else_rule)
+            return
+        for (i, e) in self.expansions(entity.expansions, t):
+            expanded = expand_rule(rule, e, entity.wildcard,
+                                   name + " #" + str(i))
+            self.write_rule(expanded)
+            if else_rule:
+                self.write_rule(replace(
+                    else_rule, name=else_rule.name + " #" + str(i),
+                    trigger=replace(else_rule.trigger,
+                                    entity_id=expanded.trigger.entity_id)))
+
+    def power_control(self, args):
+        if args[0] == '*':
+            time_off = args[1]
+            # TODO: handle all entities turning off at time_off
+            name = self._infile + ' media_power all_off'
+            (alias, self.last_alias) = (self.last_alias, None)
+            if alias:
+                name = "power_control_all_off__" + alias
+            self.write_rule(Rule(name, time_off, None, ServiceAction(
+                'homeassistant.turn_off',
+                tuple(dict.fromkeys(self.all_power_entities)), listed=True),
+                alias))
+        else:
+            # the automations are written by finish(), once every device
+            # powered by the same switch is known
+            media_zone = service_default('media_player', args[0])
+            powered_by = tuple(dict.fromkeys(
+                service_defaults('switch', args[1].entity_id)))
+            name = media_zone
+            if self.last_alias:
+                name = "power__" + self.last_alias
+                self.last_alias = None
+            self.all_power_entities.extend(powered_by)
+            for switch in powered_by:
+                if len(powered_by) > 1:
+                    # the device is among the automations of each switch,
+                    # so each needs a name of its own
+                    self.powered_devices.append(
+                        (switch, media_zone, "%s %s" % (name, switch)))
+                else:
+                    self.powered_devices.append((switch, media_zone, name))
+        return
+
+    def finish(self):
+        """Write the automations that depend on the whole file: for each
+        powered_by switch, one turning it on when any of its devices starts
+        playing and one turning it off when all of them have stopped."""
+        switches = {}
+        for (powered_by, media_zone, name) in self.powered_devices:
+            switches.setdefault(powered_by, {}).setdefault(media_zone, name)
+        self.powered_devices = []
+        idle = {'minutes': 15}
+        for (powered_by, devices) in switches.items():
+            if len(devices) == 1:
+                [(entity, name)] = devices.items()
+                entities = (entity,)
+            else:
+                (entities, name) = (tuple(devices), powered_by)
+            self.write_rule(Rule(
+                "on power " + name,
+                (StateTrigger(entities, ('playing', 'buffering'),
+                              ('idle', 'off', 'paused')),),
+                None, ServiceAction('homeassistant.turn_on', (powered_by,))))
+            condition = None
+            if len(devices) > 1:
+                # not while another device on the switch is still playing
+                condition = conditions_of('and', [
+                    StateCondition((d,), ('idle', 'off'), for_=idle)
+                    for d in devices])
+            self.write_rule(Rule(
+                "off power " + name,
+                (StateTrigger(entities, ('idle', 'off'), ('playing', 'paused'),
+                              idle),),
+                condition,
+                ServiceAction('homeassistant.turn_off', (powered_by,))))
+
+    # TODO: avoid using base_url explicitly below
+    def action(self, args):
+        _LOGGER.debug("action: %s", args)
+        if args[0] == 'play_doorbird_media':
+            entities = service_defaults('media_player', args[1].entity_id)
+            return (
+                ServiceAction('media_player.play_media', data_template={
+                    'entity_id': ",".join(entities),
+                    'media_content_id':
+                    HTTP_BASE_URL +
+                    "/api/camera_proxy_stream/camera.*_live"
+                    "?token={{states.camera.*_live.attributes.access_token}}",
+                    'media_content_type': 'image/jpg'
+                }),
+                Delay('00:00:30'),
+                ServiceAction('media_player.turn_off', entities))
+        if len(args) > 1:
+            return replace(args[1], service=args[0])
+        else:
+            return ServiceAction(args[0])
+
+    @v_args(inline=True)
+    def BRACE_EXPANDED_WORD(self, args):
+        word = str(args)
+        m = BRACES.search(word)
+        expansions = None
+        if m:
+            expansions = braceexpand(m.group())
+            word = word[:m.start()] + '*' + word[m.end():]
+        result = Braced(word, expansions)
+        _LOGGER.debug("BEW: %s -> %s", args, result)
+        return result
+
+    @v_args(inline=True)
+    def ENTITY(self, entity):
+        result = str(entity)
+        _LOGGER.debug("SN: %s -> %s", entity, result)
+        return result
+
+    @v_args(inline=True)
+    def BRACE_EXPANDED_ENTITY(self, args):
+        entity = str(args)
+        m = BRACES.search(entity)
+        if m:
+            (before, after) = (entity[:m.start()], entity[m.end():])
+            # only as many as it takes to tell that there are too many, so
+            # that a typo fails before its entity ids are all made
+            expansions = tuple(itertools.islice(braceexpand(m.group()),
+                                                MAX_EXPANSIONS + 1))
+            if len(expansions) > MAX_EXPANSIONS:
+                raise ValueError(
+                    "%s: the braces of %s expand to more than %d entity ids "
+                    "(see --max-expansions)" % (self._infile, entity,
+                                                MAX_EXPANSIONS))
+            result = EntityRef(
+                tuple(",".join(before + e + after
+                               for e in expansions).split(",")),
+                before + '*' + after, expansions)
+        else:
+            result = EntityRef(tuple(entity.split(",")))
+        _LOGGER.debug("BEE: %s -> %s", args, result)
+        return result
+
+    def RAW_VALUE(self, val):
+        answer = str(val)
+        if RepresentsInt(answer):
+            return int(answer)
+        else:
+            return answer
+
+    def ATTRIBUTE(self, val):
+        return str(val)
+
+    def DOUBLE_QUOTED_VALUE(self, val):
+        return str(val)
+
+    def SINGLE_QUOTED_VALUE(self, val):
+        return str(val)
+
+    @v_args(inline=True)
+    def SERVICE_NAME(self, args):
+        service = str(args)
+        if BRACES.search(service):
+            # the * of a service is replaced by the expansions of the
+            # braces of the trigger instead
+            raise ValueError("braces in the service %s are not supported; "
+                             "use * for the expansions of the trigger's"
+                             % service)
+        _LOGGER.debug("SN: %s -> %s", args, service)
+        return service
+
+    def HH_MM_SS(self, args):
+        return args
+
+    def MM_SS(self, args):
+        return "00:" + args
+
+    def for_clause(self, args):
+        result = ForClause(args[0])
+        _LOGGER.debug("for_clause: %s -> %s", args, result)
+        return result
+
+    def time_duration(self, args):
+        if len(args) > 1:
+            result = {str(args[1]): args[0]}
+        else:
+            result = str(args[0])
+        _LOGGER.debug("time_duration: %s -> %s", args, result)
+        return result
+
+    def TIME_LITERAL(self, args):
+        result = TimeTrigger(str(args))
+        _LOGGER.debug("TIME_LITERAL: %s -> %s", args, result)
+        return result
+
+    def TIME_LOGICAL(self, args):
+        t = str(args)
+        if t == 'solar_noon':
+            t = 'noon'
+        elif t == 'sunrise':
+            t = 'rising'
+        elif t == 'sunset':
+            t = 'setting'
+        _LOGGER.debug("TIME_LOGICAL: %s -> %s", args, t)
+        return t
+
+    def PLUSMINUS(self, args):
+        _LOGGER.debug("PLUSMINUS: %s", args)
+        return str(args)
+
+    @v_args(tree=True)
+    def time(self, t):
+        args = t.children
+        if isinstance(args[0], TimeTrigger):
+            result = args[0]
+        elif args[0] in SUN_TRIGGER_EVENTS:
+            result = SunTrigger(SUN_TRIGGER_EVENTS[args[0]])
+            if len(args) > 1:
+                result = replace(result, offset=offset_from_time_duration(
+                    args[1], args[2]))
+        else:
+            # there is no sun trigger for this event, so compare the time
+            # with the event's next time every minute
+            sun_event = args[0]
+            self.template_times.append(
+                "%s (%s)" % (lines_from_meta(self._source_name, t.meta),
+                             sun_event))
+            suffix = ""
+            if len(args) > 1:
+                suffix = " %s %s" % (args[1],
+                                     minutes_from_time_duration(args[2]))
+            result = TemplateTrigger(
+                "{{ (as_timestamp(states.sensor.time.last_changed)/60)|round "
+                "== (as_timestamp(states.sun.sun.attributes.next_%s)/60)"
+                "|round %s }}"
+                % (sun_event, suffix))
+        _LOGGER.debug("time: %s -> %s", args, result)
+        return result
+
+    def NUMBER(self, args):
+        return int(args)
+
+    def mqtt_message(self, args):
+        _LOGGER.debug("mqtt_message: %s", args)
+        return args[0]
+
+    def event(self, args):
+        _LOGGER.debug("event: %s", args)
+        return args[0]
+
+    def condition_clause(self, args):
+        result = ConditionClause(str(args[0]), args[1])
+        _LOGGER.debug("condition_clause: %s -> %s", args, result)
+        return result
+
+    def else_clause(self, args):
+        _LOGGER.debug("else_clause: %s", args)
+        return ElseClause(args[0], args[1].duration if len(args) == 3
+                          else None, args[-1])
+
+    def service_nvp(self, args):
+        if len(args) == 2:
+            headings = str(args[0]).split("/", 2)
+            if len(headings) == 2:
+                result = {headings[0]: {headings[1]: args[1]}}
+            else:
+                result = {str(args[0]): args[1]}
+        else:
+            result = str(args[0])
+        _LOGGER.debug("service_nvp: %s -> %s", args, result)
+        return result
+
+    # ServiceAction(None, entities)
+    # ServiceAction(None, ('*',))
+    # ServiceAction(None, entities, data={ nvps })
+    def service_params(self, args):
+        entities = []
+        others = {}
+        for a in args:
+            if isinstance(a, EntityRef):
+                entities.extend(a.entity_id)
+            elif isinstance(a, dict) and a.get('entity_id'):
+                entities.extend(str(a['entity_id']).split(","))
+            elif not isinstance(a, dict):
+                entities.append(str(a))
+            else:
+                dict_merge(others, a) #{**others, **a}
+        result = ServiceAction(None, tuple(entities) if entities else None)
+        if others:
+            if uses_expansion(others):
+                result = replace(result, data_template=others)
+            else:
+                result = replace(result, data=others)
+        _LOGGER.debug("service_params: %s -> %s", args, result)
+        return result
+
+    def GLOBAL_STATE(self, args):
+        if NATIVE_LOWERING:
+            (entity, states) = GLOBAL_STATES.get(
+                str(args), ("switch.%s" % args, ("true",)))
+            return StateCondition(
+                (entity,), states if len(states) > 1 else states[0])
+        if args == 'sunny':
+            template = ('{{ is_state("sensor.weather_conditions", "Clear") '
+                        'or is_state("sensor.weather_conditions", '
+                        '"Partly Cloudy") }}')
+        elif args == 'cloudy':
+            template = ('{{ is_state("sensor.weather_conditions", "Cloudy") '
+                        'or is_state("sensor.weather_conditions", "Rainy") }}')
+        elif args == 'alarm_away':
+            template = ('{{ states("alarm_control_panel.area_002") '
+                        '== "armed_away" '
+                        ' or states("alarm_control_panel.area_002") '
+                        '== "armed_vacation" }}')
+        else:
+            template = '{{ is_state("switch.%s", "true") }}' % args
+        return TemplateCondition(template)
+
+    def simple_entity_state(self, args):
+        attributes = args[2:]
+        from_state = None
+        if attributes and isinstance(attributes[0], FromClause):
+            from_state = attributes.pop(0).state
+        result = EntityState(args[0], args[1], from_state, tuple(attributes))
+        _LOGGER.debug("simple_entity_state: %s -> %s", args, result)
+        return result
+
+    def from_attr_clause(self, args):
+        _LOGGER.debug("from_attr_clause: %s", args)
+        return FromClause(args[0])
+
+    def with_attr_clause(self, args):
+        _LOGGER.debug("with_attr_clause: %s", args)
+        return (args[0], args[1])
+
+    def entity_state(self, args):
+        _LOGGER.debug("entity_state: %s", args)
+        return args[0]
+
+    def entity_state_condition(self, args):
+        _LOGGER.debug("entity_state_condition: %s", args)
+        state = args[0]
+        if isinstance(state, GroupState):
+            if NATIVE_LOWERING:
+                return conditions_of(state.connector, [
+                    StateCondition((e,), state.state)
+                    for e in state.entity_id])
+            return TemplateCondition(template_from_condis(
+                state.connector, state.entity_id, state.state))
+        # braces in a condition are not expanded into separate rules
+        result = StateCondition(
+            service_defaults('sensor', state.entity.entity_id), state.to)
+        with_condition = attributes_condition(state)
+        if with_condition:
+            result = conditions_of('and', [result, with_condition])
+        return result
+
+    def entity_disjunction(self, args):
+        result = GroupState('or', service_defaults('sensor', args))
+        _LOGGER.debug("entity_disjunction: %s -> %s", args, result)
+        return result
+
+    def entity_conjunction(self, args):
+        result = GroupState('and', service_defaults('sensor', args))
+        _LOGGER.debug("entity_conjunction: %s -> %s", args, result)
+        return result
+
+    def condis_entity_state(self, args):
+        result = replace(args[0], state=str(args[1]))
+        _LOGGER.debug("condis_entity_state: %s -> %s", args, result)
+        return result
+
+    @v_args(tree=True)
+    def time_range(self, t):
+        args = t.children
+        _LOGGER.debug("time_range: %s", Pretty(t))
+        (start_time, end_time, with_entity, (clause, start_action),
+         end_action) = args
+        name = text_from_meta(self._source, t.meta)
+        (alias, self.last_alias) = (self.last_alias, None)
+        if alias:
+            name = "time_range__" + alias
+        self.write_rule(Rule("start " + name, start_time, clause.condition,
+                             replace(start_action, entity_id=with_entity),
+                             alias))
+        self.write_rule(Rule(
+            "end " + name, end_time,
+            clause.condition if clause.keyword == 'while' else None,
+            replace(end_action, entity_id=with_entity), alias))
+
+    def with_clause(self, args):
+        if isinstance(args[0], EntityState):
+            result = args[0].entity.entity_id
+        elif isinstance(args[0], GroupState):
+            result = args[0].entity_id
+        else:
+            result = (args[0],)
+        _LOGGER.debug("with_clause: %s -> %s", args, result)
+        return result
+
+    def start_clause(self, args):
+        _LOGGER.debug("start_clause: %s", args)
+        return args
+
+    def end_clause(self, args):
+        _LOGGER.debug("end_clause: %s", args)
+        return args[0]
+
+
+# a line starting in the first column starts a new top-level rule unless
+# it starts with one of these, which only ever continue a rule
+RULE_CONTINUATION = re.compile(
+    r'(do|else|with|start|end|for|and|or|is|fires|changes|to)\b'
+    r'|==|\(|\.\.\.|[+-]')
+
+
+def split_rules(lines):
+    """Group the lines of a file (a Source, or any iterable of lines such
+    as the file itself) into (first line number, text) chunks, starting a
+    new chunk at each line that can start a top-level rule.  A chunk may
+    end up holding less than a whole rule (compile_rules() then joins it
+    to the next one), but never holds the start of one rule and the end of
+    another."""
+    if isinstance(lines, Source):
+        yield from lines.chunks()
+        return
+    first = 1
+    chunk = []
+    for (i, line) in enumerate(lines, 1):
+        if (chunk and line[:1] not in ('', ' ', '\t', '\r', '\n', '#')
+                and not RULE_CONTINUATION.match(line)):
+            yield (first, "".join(chunk))
+            first = i
+            chunk = []
+        chunk.append(line)
+    yield (first, "".join(chunk))
+
+
+# the newline before each line of UTF-8 text that can start a top-level
+# rule, as split_rules() decides it (a word of RULE_CONTINUATION ends at a
+# byte that cannot be part of a word)
+RULE_START = re.compile(
+    rb'\n(?=[^ \t\r\n#])(?!' + RULE_CONTINUATION.pattern.replace(
+        r'\b', r'(?![\w\x80-\xff])').encode('ascii') + rb')')
+NEWLINE = re.compile(rb'\n')
+
+
+class Source:
+    """The text of a .hgl file, as UTF-8 bytes (a memory map of the file,
+    where it can be mapped), and the offset of the start of each of its
+    lines, so that a line or the text of a rule is decoded straight from
+    the bytes without the file ever being copied into a list of lines.  A
+    Source of a chunk of a file, from first_line on, is indexed by the
+    line numbers of the file."""
+
+    def __init__(self, data, first_line=1):
+        self._data = data
+        self._first = first_line
+        # the offset of each line, indexed when a line is first wanted
+        self._starts = None
+
+    def _index(self):
+        data = self._data
+        starts = array('I' if len(data) < 1 << 32 else 'Q', [0])
+        starts.extend(m.end() for m in NEWLINE.finditer(data))
+        if starts[-1] < len(data):
+            # the last line has no newline
+            starts.append(len(data))
+        self._starts = starts
+        return starts
+
+    @classmethod
+    def from_text(cls, text, first_line=1):
+        return cls(text.encode('utf8'), first_line)
+
+    @classmethod
+    def of(cls, lines):
+        """lines as a Source: lines itself if it is one, a map of the file
+        if it is a UTF-8 file just opened, or else a LineSource reading its
+        lines as they are wanted (for a pipe, an empty file or one with \\r
+        newlines, which the file would translate)."""
+        if isinstance(lines, Source):
+            return lines
+        encoding = getattr(lines, 'encoding', None)
+        try:
+            if encoding and codecs.lookup(encoding).name == 'utf-8':
+                data = mmap.mmap(lines.fileno(), 0, access=mmap.ACCESS_READ)
+                if data.find(b'\r') < 0:
+                    return cls(data)
+                data.close()
+        except (LookupError, OSError, ValueError):
+            pass
+        return LineSource(lines)
+
+    def chunks(self):
+        """The chunks of split_rules(), each decoded from the bytes between
+        two starts of rules."""
+        (data, first, offset) = (self._data, self._first, 0)
+        for m in RULE_START.finditer(data):
+            end = m.end()
+            text = data[offset:end].decode('utf8')
+            yield (first, text)
+            first += text.count('\n')
+            offset = end
+        yield (first, data[offset:].decode('utf8'))
+
+    def line(self, n):
+        """Line n, without its newline."""
+        starts = self._starts or self._index()
+        n -= self._first
+        return self._data[starts[n]:starts[n + 1]].decode('utf8').rstrip(
+            '\r\n')
+
+    def release(self, n):
+        """Note that no line before line n is wanted any more."""
+
+
+class LineSource(Source):
+    """A Source of lines that cannot be mapped, such as those of a pipe,
+    read one at a time as its chunks are wanted.  Only the lines from the
+    last line passed to release() on are kept, so compiling rule by rule
+    from a pipe holds no more of it than a rule."""
+
+    def __init__(self, lines, first_line=1):
+        self._lines = lines
+        self._first = first_line
+        # the lines read, from line self._first on
+        self._kept = []
+
+    def _read(self):
+        for line in self._lines:
+            self._kept.append(line)
+            yield line
+
+    def chunks(self):
+        offset = self._first - 1
+        for (first, text) in split_rules(self._read()):
+            yield (first + offset, text)
+
+    def line(self, n):
+        return self._kept[n - self._first].rstrip('\r\n')
+
+    def release(self, n):
+        if n > self._first:
+            del self._kept[:n - self._first]
+            self._first = n
+
+
+class RuleCache:
+    """The YAML of each top-level rule of one .hgl file, from its last
+    compile, keyed by the rule's text and the context it was compiled in
+    (but not where it is in the file: the locations in the names of its
+    automations, such as when_r-h:12, are kept relative to its first line
+    and moved to wherever it is now)."""
+
+    # the fields of an entry that may hold locations
+    LOCATED = ('yaml', 'automation_ids', 'template_times',
+               'unknown_entities')
+
+    def __init__(self, infile, salt):
+        key = hashlib.sha256(
+            os.path.abspath(infile).encode('utf8')).hexdigest()[:16]
+        self._path = GRAMMAR_CACHE_DIR / "rules" / ("%s.pickle" % key)
+        # the name of infile is in the YAML of its power_control rules
+        self._salt = salt + "\0" + infile
+        source_name = re.escape(shorten_fname(infile))
+        self._location = re.compile(source_name + r':(\d+)(?:-(\d+))?')
+        self._relative = re.compile(source_name + r':@(\d+)(?:-@(\d+))?')
+        # a list of entries for each key, as identical rules (with ids of
+        # their own) have the same one
+        self._old = {}
+        self._new = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self._path, "rb") as f:
+                self._old = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+
+    def key(self, text, mqtt_topic, last_alias):
+        """The key of the rule text, compiled with the mqtt_topic and the
+        last_alias (an alias not yet consumed) left by the rules before
+        it."""
+        return hashlib.sha256("\0".join(
+            (self._salt, text, mqtt_topic,
+             last_alias or "")).encode('utf8')).hexdigest()
+
+    def _moved(self, entry, pattern, location):
+        """entry with each match of pattern in its LOCATED fields replaced
+        by location(match)."""
+        def move(value):
+            if isinstance(value, str):
+                return pattern.sub(location, value)
+            if isinstance(value, (list, tuple)):
+                return type(value)(move(v) for v in value)
+            return value
+        return dict(entry, **{f: move(entry[f]) for f in self.LOCATED
+                              if f in entry})
+
+    def _relative_to(self, entry, line, text):
+        """entry, compiled from text on line, with the locations within
+        text made relative to line."""
+        last = line + text.count('\n')
+
+        def relative(m):
+            lines = [int(n) for n in m.groups() if n is not None]
+            if not all(line <= n <= last for n in lines):
+                return m.group(0)
+            return m.group(0)[:m.start(1) - m.start(0)] + "-".join(
+                "@%d" % (n - line) for n in lines)
+        return self._moved(entry, self._location, relative)
+
+    def get(self, key, outputter, line):
+        """The cached entry for key, with its locations moved to line,
+        unless it was compiled from different power_control entities than
+        outputter has now, its automations would now have other ids
+        (outputter.ids_current()), or a file it includes has changed
+        since."""
+        for entry in self._old.get(key, ()):
+            if (entry['power_read'] in (None, outputter.all_power_entities)
+                    and outputter.ids_current(
+                        entry.get('automation_ids', ()))
+                    and modules_current(entry.get('included', ()))):
+                break
+        else:
+            return None
+        self._new.setdefault(key, []).append(entry)
+        if entry['incomplete']:
+            return entry
+        self.hits += 1
+
+        def absolute(m):
+            lines = [int(n) + line for n in m.groups() if n is not None]
+            return m.group(0)[:m.start(1) - m.start(0) - 1] + "-".join(
+                map(str, lines))
+        return self._moved(entry, self._relative, absolute)
+
+    def put(self, key, entry, line, text):
+        """Cache entry, compiled from text on line, for key."""
+        if not entry['incomplete']:
+            self.misses += 1
+            entry = self._relative_to(entry, line, text)
+        self._new.setdefault(key, []).append(entry)
+
+    def save(self):
+        """Write out the entries used by this compile (and only those)."""
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self._path.with_suffix(".tmp%d" % os.getpid())
+            with open(tmp, "wb") as f:
+                pickle.dump(self._new, f)
+            os.replace(tmp, self._path)
+        except OSError as e:
+            _LOGGER.warning("Not caching rules: %s", e)
+
+
+def file_digest(path):
+    """The sha256 of the content of the file path."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def module_name(infile, target):
+    """The name of the file that an include of target in infile names:
+    target, relative to the directory of infile."""
+    return os.path.normpath(os.path.join(os.path.dirname(infile), target))
+
+
+def modules_current(included):
+    """Whether every file of included, (path, digest) pairs, still has
+    that digest."""
+    try:
+        return all(file_digest(path) == digest
+                   for (path, digest) in included)
+    except OSError:
+        return False
+
+
+# the modules compiled or loaded by this process, by the name of their file
+compiled_modules = {}
+
+
+class ModuleStore:
+    """The modules of the files that rules include.  A module is its file
+    compiled on its own: from the default TOPIC, with no power_control
+    devices before it and without finish(), so that it is the same
+    wherever it is included.  Each is kept in this process and in the
+    module cache on disk, keyed by the content of its file, and reused for
+    as long as neither that nor the content of any file it includes
+    changes."""
+
+    def __init__(self, parser):
+        self._parser = parser
+        # the compiler_fingerprint(), when first needed
+        self._salt = None
+
+    def get(self, name, including=()):
+        """The module of the file name, included from the files including
+        (for detecting a cycle of includes)."""
+        if self._salt is None:
+            self._salt = compiler_fingerprint(self._parser.options.parser,
+                                              'module')
+        module = compiled_modules.get(name)
+        if (module is not None and module['salt'] == self._salt
+                and modules_current(module['included'])):
+            return module
+        digest = file_digest(name)
+        key = hashlib.sha256("\0".join(
+            (self._salt, os.path.abspath(name), name, digest)).encode(
+                'utf8')).hexdigest()
+        cache = GRAMMAR_CACHE_DIR / "modules" / ("%s.pickle" % key[:32])
+        module = None
+        try:
+            with open(cache, "rb") as f:
+                module = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        if module is None or not modules_current(module['included']):
+            module = self._compile(name, digest, including)
+            try:
+                cache.parent.mkdir(parents=True, exist_ok=True)
+                tmp = cache.with_suffix(".tmp%d" % os.getpid())
+                with open(tmp, "wb") as f:
+                    pickle.dump(module, f)
+                os.replace(tmp, cache)
+            except OSError as e:
+                _LOGGER.warning("Not caching the module %s: %s", name, e)
+        compiled_modules[name] = module
+        return module
+
+    def _compile(self, name, digest, including):
+        _LOGGER.info("compiling the module %s", name)
+        outputter = HassOutputter(name, AutomationList(), None, self,
+                                  including, visit_tokens=True)
+        with open(name, "r") as f:
+            outputter._source = Source.of(f)
+            carry = None
+            for (line, text) in split_rules(outputter._source):
+                if carry:
+                    (line, text) = (carry[0], carry[1] + text)
+                    carry = None
+                try:
+                    t = parse(self._parser, text, line)
+                except UnexpectedInput as e:
+                    if not ended_early(e):
+                        raise
+                    carry = (line, text)
+                    continue
+                try:
+                    outputter.transform(t)
+                except VisitError as e:
+                    # as if the module were compiled by itself
+                    raise e.orig_exc from e
+            if carry:
+                # an error in the last rule: parse it again to report it
+                parse(self._parser, carry[1], carry[0])
+        return {'salt': self._salt,
+                'automations': outputter._out.take(),
+                'mqtt_topic': outputter.designated_topic,
+                'power_added': outputter.all_power_entities,
+                'powered_devices': outputter.powered_devices,
+                'template_times': outputter.template_times,
+                'unknown_entities': outputter.unknown_entities,
+                'included': [(os.path.abspath(name), digest)] +
+                            outputter.included}
+
+
+# the characters of a glob pattern of entity ids, as in light.hall_*
+ENTITY_GLOB = re.compile(r'[*?\[]')
+
+
+class EntityRegistry:
+    """The entity ids of a snapshot of Home Assistant's entity registry
+    (.storage/core.entity_registry), indexed by domain and sorted by
+    object id, for checking the entity ids of automations and resolving
+    glob patterns of them."""
+
+    def __init__(self, entity_ids, digest=""):
+        self.entity_ids = frozenset(entity_ids)
+        self.digest = digest
+        self._by_domain = {}
+        for e in sorted(self.entity_ids):
+            (domain, _, object_id) = e.partition('.')
+            self._by_domain.setdefault(domain, []).append(object_id)
+
+    @classmethod
+    def load(cls, path):
+        """The registry of the file path, or of the Home Assistant
+        configuration directory path, from the cache of its index unless
+        the file has changed since."""
+        path = Path(path)
+        if path.is_dir():
+            path = path / ".storage" / "core.entity_registry"
+        st = path.stat()
+        digest = hashlib.sha256("\0".join(
+            (os.path.abspath(path), str(st.st_mtime_ns),
+             str(st.st_size))).encode('utf8')).hexdigest()
+        cache = GRAMMAR_CACHE_DIR / "registry" / ("%s.pickle" % digest[:16])
+        try:
+            with open(cache, "rb") as f:
+                registry = pickle.load(f)
+            if registry.digest == digest:
+                return registry
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+        with open(path, "r") as f:
+            entities = json.load(f)['data']['entities']
+        registry = cls((e['entity_id'] for e in entities), digest)
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache.with_suffix(".tmp%d" % os.getpid())
+            with open(tmp, "wb") as f:
+                pickle.dump(registry, f)
+            os.replace(tmp, cache)
+        except OSError as e:
+            _LOGGER.warning("Not caching the entity registry: %s", e)
+        return registry
+
+    def __contains__(self, entity_id):
+        return entity_id in self.entity_ids
+
+    def match(self, pattern):
+        """The entity ids matching the glob pattern, in order: those of its
+        domain starting with the part of its object id before the first
+        wildcard, that match the rest."""
+        (domain, _, object_pattern) = pattern.partition('.')
+        if ENTITY_GLOB.search(domain):
+            return [m for d in sorted(self._by_domain)
+                    if fnmatch.fnmatchcase(d, domain)
+                    for m in self.match(d + '.' + object_pattern)]
+        object_ids = self._by_domain.get(domain, [])
+        prefix = ENTITY_GLOB.split(object_pattern, 1)[0]
+        matches = []
+        for i in range(bisect.bisect_left(object_ids, prefix),
+                       len(object_ids)):
+            if not object_ids[i].startswith(prefix):
+                break
+            if fnmatch.fnmatchcase(object_ids[i], object_pattern):
+                matches.append(domain + '.' + object_ids[i])
+        return matches
+
+    def _entity_ids(self, value, unknown):
+        """value, the entity_id of something, with its patterns replaced by
+        the list of entity ids they match; those it has that are not
+        registered are added to unknown.  A pattern that matches nothing
+        is a ValueError, since Home Assistant would reject it."""
+        ids = value.split(",") if isinstance(value, str) else value
+        if not isinstance(ids, list):
+            return value
+        resolved = []
+        for e in ids:
+            # a * the braces of a trigger did not replace is not an entity
+            # id to check (or resolve) either
+            if (not isinstance(e, str) or "{" in e
+                    or e in ('all', 'none', '*')):
+                resolved.append(e)
+                continue
+            if ENTITY_GLOB.search(e):
+                matches = self.match(e)
+                if not matches:
+                    raise ValueError("%s matches no entity in the entity "
+                                     "registry" % e)
+                resolved.extend(matches)
+                continue
+            if e not in self.entity_ids:
+                unknown.append(e)
+            resolved.append(e)
+        return value if len(resolved) == len(ids) and resolved == ids \
+            else resolved
+
+    def resolve(self, automation):
+        """automation with the patterns in its entity ids resolved (copying
+        only what that changes), and the entity ids it has that are not
+        registered; raises ValueError for a pattern that matches
+        nothing."""
+        unknown = []
+
+        def walk(obj):
+            if isinstance(obj, dict):
+                new = None
+                for (k, v) in obj.items():
+                    r = (self._entity_ids(v, unknown) if k == 'entity_id'
+                         else walk(v))
+                    if r is not v:
+                        new = new or dict(obj)
+                        new[k] = r
+                return obj if new is None else new
+            if isinstance(obj, list):
+                items = [walk(v) for v in obj]
+                if any(a is not b for (a, b) in zip(items, obj)):
+                    return items
+            return obj
+        return (walk(automation), unknown)
+
+
+class Profile:
+    """The wall time and tracemalloc peak of each phase of a compile (with
+    tracemalloc tracing throughout), and what each top-level rule cost, for
+    --profile.  A phase's time excludes the phases timed within it (emit
+    happens inside transform)."""
+
+    PHASES = ('grammar', 'read', 'parse', 'transform', 'emit')
+
+    def __init__(self):
+        self.phases = {p: {'seconds': 0.0, 'peak_bytes': 0}
+                       for p in self.PHASES}
+        self.rules = []
+        self.last = {}
+        self._stack = []
+
+    def _peak(self, frame):
+        (phase, _, base, _) = frame
+        peak = tracemalloc.get_traced_memory()[1] - base
+        if peak > self.phases[phase]['peak_bytes']:
+            self.phases[phase]['peak_bytes'] = peak
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        if self._stack:
+            # the peak is about to be reset, so take the outer phase's now
+            self._peak(self._stack[-1])
+        tracemalloc.reset_peak()
+        frame = [phase, time.perf_counter(),
+                 tracemalloc.get_traced_memory()[0], 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            seconds = time.perf_counter() - frame[1]
+            self._peak(frame)
+            if self._stack:
+                self._stack[-1][3] += seconds
+            self.last[phase] = seconds - frame[3]
+            self.phases[phase]['seconds'] += seconds - frame[3]
+
+    def timed(self, phase, f):
+        def timed_f(*args):
+            with self.phase(phase):
+                return f(*args)
+        return timed_f
+
+    def timed_iter(self, phase, iterable):
+        """iterable, with the time taken to get each item charged to
+        phase."""
+        it = iter(iterable)
+        while True:
+            with self.phase(phase):
+                item = next(it, self)
+            if item is self:
+                return
+            yield item
+
+    def rule(self, source_name, t, entry, automations):
+        """Record the cost of the rules of the parse tree t of the file
+        shortened to source_name, just compiled to entry and automations
+        automations."""
+        self.rules.append({
+            'location': lines_from_meta(source_name, t.meta),
+            'rule': ",".join(c.data for c in t.children if c.data != 'alias'),
+            'parse_seconds': self.last['parse'],
+            'transform_seconds': self.last['transform'],
+            'automations': automations,
+            'bytes': len(entry['yaml'].encode('utf8'))})
+
+    def report(self, out, top=20):
+        """Write the phases and the top most costly rules to out as
+        tables."""
+        out.write("%-10s %10s %12s\n" % ("phase", "seconds", "peak KiB"))
+        for (p, v) in self.phases.items():
+            out.write("%-10s %10.3f %12.0f\n" % (p, v['seconds'],
+                                                 v['peak_bytes'] / 1024))
+        rules = sorted(self.rules, key=lambda r: -(r['parse_seconds'] +
+                                                   r['transform_seconds']))
+        out.write("\n%-24s %-22s %9s %9s %6s %8s\n" % (
+            "rule", "kind", "parse ms", "xform ms", "autos", "bytes"))
+        for r in rules[:top]:
+            out.write("%-24s %-22s %9.2f %9.2f %6d %8d\n" % (
+                r['location'], r['rule'][:22], r['parse_seconds'] * 1000,
+                r['transform_seconds'] * 1000, r['automations'], r['bytes']))
+        if len(rules) > top:
+            out.write("(%d more rules)\n" % (len(rules) - top))
+
+    def to_json(self):
+        return {'phases': self.phases, 'rules': self.rules}
+
+
+def profiled(profile, phase):
+    """profile.phase(phase), or nothing without a Profile."""
+    return profile.phase(phase) if profile else contextlib.nullcontext()
+
+
+def compiler_fingerprint(engine, emitter):
+    """Everything besides a rule's own text and context that its YAML
+    depends on."""
+    return hashlib.sha256(Path(__file__).read_bytes() + Path(
+        __file__).with_name("ir.py").read_bytes() + "\0".join(
+        (lark_version, engine, emitter, HTTP_BASE_URL,
+         str(MAX_EXPANSIONS), str(NATIVE_LOWERING),
+         ENTITY_REGISTRY.digest if ENTITY_REGISTRY else "")).encode(
+            'utf8')).hexdigest()
+
+
+def transform_rule(outputter, t, first_line, text):
+    """Transform the parse tree t of text, one or more whole rules starting
+    on line first_line, with outputter and return their RuleCache entry."""
+    power_read = None
+    if any(r.data == 'power_control' and r.children[0] == '*'
+           for r in t.children):
+        power_read = list(outputter.all_power_entities)
+    power_before = len(outputter.all_power_entities)
+    devices_before = len(outputter.powered_devices)
+    templates_before = len(outputter.template_times)
+    unknown_before = len(outputter.unknown_entities)
+    ids_before = len(outputter.automation_ids)
+    included_before = len(outputter.included)
+    outputter.transform(t)
+    return {'incomplete': False,
+            'yaml': outputter._out.take(),
+            'mqtt_topic': outputter.mqtt_topic,
+            'last_alias': outputter.last_alias,
+            'power_added': outputter.all_power_entities[power_before:],
+            'power_read': power_read,
+            'powered_devices': outputter.powered_devices[devices_before:],
+            'template_times': outputter.template_times[templates_before:],
+            'unknown_entities': outputter.unknown_entities[unknown_before:],
+            'automation_ids': outputter.automation_ids[ids_before:],
+            'included': outputter.included[included_before:]}
+
+
+def report_rules(infile, outputter):
+    """Log how many of the rules of infile have a template standing in for
+    a sun trigger (and, at DEBUG, which), the entity ids they use that are
+    not in the ENTITY_REGISTRY, and the automations with the same id
+    before telling them apart: those that do the same or, with a name
+    given to their rule, have the same name."""
+    if outputter.template_times:
+        _LOGGER.info("%s: %d template triggers standing in for sun "
+                     "triggers (--debug lists them)", infile,
+                     len(outputter.template_times))
+        for location in outputter.template_times:
+            _LOGGER.debug("%s: no sun trigger for %s; using a template "
+                          "trigger", infile, location)
+    if outputter.unknown_entities:
+        _LOGGER.warning("%s: %d entity ids not in the entity registry: %s",
+                        infile, len(outputter.unknown_entities),
+                        ", ".join(outputter.unknown_entities))
+    aliases = {}
+    for (id, _, alias) in outputter.automation_ids:
+        aliases.setdefault(id, []).append(alias)
+    same = [" = ".join(a) for a in aliases.values() if len(a) > 1]
+    if same:
+        _LOGGER.warning("%s: automations that do the same, or have the "
+                        "same name (each with an id of its own): %s", infile,
+                        "; ".join(same))
+
+
+def compile_rules(parser, infile, lines, out, cache=None, emitter='fast',
+                  profile=None):
+    """Compile the lines of infile (a Source, or the open file, which is
+    mapped into one or else read a line at a time) rule by rule, writing
+    the YAML of each rule (from the named emitter) through a buffer to out
+    as soon as it is converted, so only the text and YAML of one rule (and
+    the ids of the automations written) are held in memory.
+    With a RuleCache, the YAML of every rule that is unchanged since the
+    last compile of infile is reused.  With a Profile, the phases of the
+    compile of every rule are timed."""
+    with profiled(profile, 'read'):
+        source = Source.of(lines)
+    outputter = HassOutputter(
+        infile, AutomationWriter(None, emitter, profile=profile), source,
+        ModuleStore(parser), visit_tokens=True)
+    writer = AutomationWriter(out, emitter)
+    carry = None
+    chunks = split_rules(source)
+    if profile:
+        chunks = profile.timed_iter('read', chunks)
+    for (line, text) in chunks:
+        if carry:
+            (line, text) = (carry[0], carry[1] + text)
+            carry = None
+        source.release(line)
+        entry = None
+        if cache:
+            key = cache.key(text, outputter.mqtt_topic,
+                            outputter.last_alias)
+            entry = cache.get(key, outputter, line)
+        if entry is None:
+            try:
+                with profiled(profile, 'parse'):
+                    t = parse(parser, text, line)
+            except UnexpectedInput as e:
+                if not ended_early(e):
+                    raise
+                entry = {'incomplete': True, 'power_read': None}
+            else:
+                automations = outputter._out.automations
+                with profiled(profile, 'transform'):
+                    entry = transform_rule(outputter, t, line, text)
+                if profile:
+                    profile.rule(outputter._source_name, t, entry,
+                                 outputter._out.automations - automations)
+            if cache:
+                cache.put(key, entry, line, text)
+        elif not entry['incomplete']:
+            outputter.mqtt_topic = entry['mqtt_topic']
+            outputter.last_alias = entry['last_alias']
+            outputter.all_power_entities.extend(entry['power_added'])
+            outputter.powered_devices.extend(entry['powered_devices'])
+            outputter.template_times.extend(entry['template_times'])
+            outputter.unknown_entities.extend(entry['unknown_entities'])
+            outputter.add_ids(entry['automation_ids'])
+            outputter.included.extend(entry['included'])
+        if entry['incomplete']:
+            # not a whole rule, so try again with the next chunk appended
+            carry = (line, text)
+        else:
+            writer.write(entry['yaml'])
+    if carry:
+        # an error in the last rule: parse it again to report it
+        parse(parser, carry[1], carry[0])
+    outputter.finish()
+    writer.write(outputter._out.take())
+    writer.flush()
+    report_rules(infile, outputter)
+    if cache:
+        cache.save()
+        _LOGGER.info("%s: %d rules reused, %d compiled", infile, cache.hits,
+                     cache.misses)
+
+
+# a TOPIC designation, as it starts a chunk from split_rules()
+TOPIC_DESIGNATION = re.compile(
+    r'(?:[_0-9a-zA-Z ]+:\s*)?TOPIC\s+([/_0-9a-zA-Z]+)')
+
+# the fewest chunks worth handing to a worker
+MIN_PARALLEL_CHUNKS = 32
+
+
+def parallel_batches(chunks, batches):
+    """Divide chunks, the (first line, text) chunks of a file, into about
+    batches runs of consecutive chunks, each with the MQTT topic that the
+    TOPIC designations before it should leave in effect."""
+    size = max(-(-len(chunks) // batches), MIN_PARALLEL_CHUNKS)
+    topic = DEFAULT_MQTT_TOPIC
+    result = []
+    for start in range(0, len(chunks), size):
+        run = chunks[start:start + size]
+        result.append((topic, run))
+        for (_, text) in run:
+            m = TOPIC_DESIGNATION.match(text)
+            if m:
+                topic = m.group(1)
+    return result
+
+
+# an include directive, as it starts a chunk from split_rules()
+INCLUDE_DIRECTIVE = re.compile(r'include\s+"([^"\n]+)"')
+
+
+def precompile_modules(modules, infile, chunks):
+    """Compile (or load) the modules that the chunks of infile include
+    with modules, a ModuleStore, so that the processes then compiling its
+    rules each find them in the module cache instead of compiling them
+    too, and return the (absolute) paths of the files they include,
+    however indirectly.  Any error is left for those to report."""
+    included = {}
+    for (_, text) in chunks:
+        m = INCLUDE_DIRECTIVE.match(text)
+        if m is None:
+            continue
+        try:
+            module = modules.get(module_name(infile, m.group(1)), (infile,))
+        except Exception as e:
+            _LOGGER.debug("%s: not precompiling %s: %s", infile,
+                          m.group(1), e)
+            continue
+        included.update(dict.fromkeys(path for (path, _)
+                                      in module['included']))
+    return list(included)
+
+
+def includes_of(modules, infile):
+    """precompile_modules() for the file infile (none if it cannot be
+    read)."""
+    try:
+        with open(infile, "r") as f:
+            return precompile_modules(modules, infile,
+                                      split_rules(Source.of(f)))
+    except OSError:
+        return []
+
+
+def top_level_files(infiles, parser):
+    """infiles without those included (however indirectly) by any of them,
+    whose rules are compiled into the files including them; the modules
+    included are compiled (or loaded) on the way."""
+    modules = ModuleStore(parser)
+    included = set()
+    for infile in infiles:
+        included.update(includes_of(modules, infile))
+    result = []
+    for infile in infiles:
+        if os.path.abspath(infile) in included:
+            _LOGGER.info("%s: not compiled on its own, as other files "
+                         "include it", infile)
+        else:
+            result.append(infile)
+    return result
+
+
+def compile_chunks(job):
+    """Compile, in a worker process, a run of consecutive chunks of infile
+    (from parallel_batches()) as if the file started with them.  Returns
+    the transform_rule() entry of each rule, with its source (for the
+    caller to compile again), and any incomplete rule left at the end;
+    or None if they failed to compile, leaving the caller to compile them
+    itself and report the error."""
+    (infile, mqtt_topic, chunks) = job
+    outputter = HassOutputter(infile, AutomationWriter(None, batch_emitter),
+                              modules=ModuleStore(batch_parser),
+                              visit_tokens=True)
+    outputter.mqtt_topic = mqtt_topic
+    entries = []
+    carry = None
+    try:
+        for (line, text) in chunks:
+            if carry:
+                (line, text) = (carry[0], carry[1] + text)
+                carry = None
+            try:
+                t = parse(batch_parser, text, line)
+            except UnexpectedInput as e:
+                if not ended_early(e):
+                    raise
+                carry = (line, text)
+                continue
+            outputter._source = Source.from_text(text, line)
+            entry = transform_rule(outputter, t, line, text)
+            entry['source'] = (line, text)
+            entries.append(entry)
+    except Exception:
+        return None
+    return (entries, carry)
+
+
+def compile_rules_parallel(parser, infile, lines, out, emitter='fast',
+                           jobs=None, settings=None):
+    """Compile the lines of infile like compile_rules(), but with runs of
+    its rules parsed and transformed across a pool of jobs processes
+    (configure()d with settings), and their YAML written to out in the
+    order of the file.
+
+    The rules of a run are compiled without those before them, so a run
+    is compiled again here whenever that would make a difference: when it
+    starts within a rule, under a different TOPIC than expected or with a
+    rule name (alias) left unused by the rule before it.  Each rule that
+    turns off every powered entity (* off_at) is also compiled again
+    here, with the power_control entities of the whole file before it, as
+    is each rule doing the same as one in a run before it (whose
+    automations need ids of their own).  The modules that infile includes
+    are compiled here first."""
+    source = Source.of(lines)
+    chunks = list(split_rules(source))
+    batches = parallel_batches(chunks, (jobs or os.cpu_count() or 1) * 4)
+    modules = ModuleStore(parser)
+    precompile_modules(modules, infile, chunks)
+    outputter = HassOutputter(infile, AutomationWriter(None, emitter), source,
+                              modules, visit_tokens=True)
+    writer = AutomationWriter(out, emitter)
+    carry = None
+    recompiled = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=batch_init,
+                             initargs=(parser.options.parser, True, False,
+                                       emitter, settings or {})) as pool:
+        results = pool.map(compile_chunks, [(infile, topic, run)
+                                            for (topic, run) in batches])
+        for ((topic, run), result) in zip(batches, results):
+            if (result is None or carry or outputter.last_alias
+                    or outputter.mqtt_topic != topic):
+                recompiled += 1
+                for (line, text) in run:
+                    if carry:
+                        (line, text) = (carry[0], carry[1] + text)
+                        carry = None
+                    try:
+                        t = parse(parser, text, line)
+                    except UnexpectedInput as e:
+                        if not ended_early(e):
+                            raise
+                        carry = (line, text)
+                        continue
+                    writer.write(transform_rule(outputter, t, line,
+                                                text)['yaml'])
+                continue
+            (entries, carry) = result
+            for entry in entries:
+                if (entry['power_read'] is not None
+                        or not outputter.ids_current(entry['automation_ids'])):
+                    (line, text) = entry['source']
+                    entry = transform_rule(outputter,
+                                           parse(parser, text, line), line,
+                                           text)
+                else:
+                    outputter.mqtt_topic = entry['mqtt_topic']
+                    outputter.last_alias = entry['last_alias']
+                    outputter.all_power_entities.extend(entry['power_added'])
+                    outputter.powered_devices.extend(
+                        entry['powered_devices'])
+                    outputter.template_times.extend(entry['template_times'])
+                    outputter.unknown_entities.extend(
+                        entry['unknown_entities'])
+                    outputter.add_ids(entry['automation_ids'])
+                    outputter.included.extend(entry['included'])
+                writer.write(entry['yaml'])
+    if carry:
+        # an error in the last rule: parse it again to report it
+        parse(parser, carry[1], carry[0])
+    outputter.finish()
+    writer.write(outputter._out.take())
+    writer.flush()
+    report_rules(infile, outputter)
+    _LOGGER.debug("%s: %d of %d runs of rules recompiled in order", infile,
+                  recompiled, len(batches))
+
+
+def automations(parser, infile, lines):
+    """Yield the automations, as dicts, of the lines of infile as each rule
+    is converted."""
+    source = Source.of(lines)
+    outputter = HassOutputter(infile, AutomationList(), source,
+                              ModuleStore(parser), visit_tokens=True)
+    carry = None
+    for (line, text) in split_rules(source):
+        if carry:
+            (line, text) = (carry[0], carry[1] + text)
+            carry = None
+        source.release(line)
+        try:
+            t = parse(parser, text, line)
+        except UnexpectedInput as e:
+            if not ended_early(e):
+                raise
+            # not a whole rule, so try again with the next chunk appended
+            carry = (line, text)
+            continue
+        outputter.transform(t)
+        yield from outputter._out.take()
+    if carry:
+        # an error in the last rule: parse it again to report it
+        parse(parser, carry[1], carry[0])
+    outputter.finish()
+    yield from outputter._out.take()
+    report_rules(infile, outputter)
+
+
+# the keys of automations that may differ between those merged
+MERGED_KEYS = ('id', 'alias', 'condition', 'action')
+
+
+def merged_automation(group):
+    """One automation doing what each of group, automations with the same
+    trigger, did: their actions run in parallel, each under the conditions
+    of its own automation, and in parallel with any earlier run."""
+    steps = []
+    for a in group:
+        actions = a['action'] if isinstance(a['action'], list) else [
+            a['action']]
+        condition = a.get('condition')
+        if condition:
+            steps.append({'choose': [{
+                'conditions': (condition if isinstance(condition, list)
+                               else [condition]),
+                'sequence': actions}]})
+        elif len(actions) == 1:
+            steps.append(actions[0])
+        else:
+            steps.append({'sequence': actions})
+    first = group[0]
+    # it keeps the id of the first, as it takes its place
+    merged = {'id': first['id']} if 'id' in first else {}
+    merged['alias'] = first['alias']
+    merged['description'] = "Merged from: " + ", ".join(
+        a['alias'] for a in group)
+    for (k, v) in first.items():
+        if k not in MERGED_KEYS:
+            merged[k] = v
+    # a trigger may run the automation again while another rule's actions
+    # are still running, as it could when they were separate automations
+    merged.setdefault('mode', 'parallel')
+    merged['action'] = [{'parallel': steps}]
+    return merged
+
+
+def merge_triggers(automations):
+    """The automations, in order, with those whose triggers (and everything
+    else but their aliases, conditions and actions) are equal merged into
+    one, where the first of them was; and how many automations that
+    eliminated."""
+    groups = {}
+    for a in automations:
+        key = json.dumps({k: v for (k, v) in a.items()
+                          if k not in MERGED_KEYS},
+                         sort_keys=True, default=str)
+        groups.setdefault(key, []).append(a)
+    merged = [g[0] if len(g) == 1 else merged_automation(g)
+              for g in groups.values()]
+    return (merged, sum(len(g) - 1 for g in groups.values()))
+
+
+def write_merged(infile, automations, out, emitter='fast'):
+    """Write automations, from infile, to out with merge_triggers()."""
+    (merged, eliminated) = merge_triggers(automations)
+    writer = AutomationWriter(out, emitter)
+    for a in merged:
+        writer.write_automation(a)
+    writer.flush()
+    _LOGGER.info("%s: merging triggers eliminated %d automations, "
+                 "leaving %d", infile, eliminated, len(merged))
+
+
+def compile_stream(parser, infile, inf, out, rule_cache=True,
+                   emitter='fast', profile=None, parallel=False, jobs=None,
+                   settings=None):
+    """Compile inf, the open infile, to out.  With parallel, its rules are
+    compiled by compile_rules_parallel() across jobs processes
+    (configure()d with settings) and neither rule_cache nor profile is
+    used.  When configure()d to merge_triggers, the whole file is compiled
+    and merged before it is written, without rule_cache, parallel or
+    profile.  When configure()d to trace, rule_cache is not used either,
+    so that every rule is transformed and traced."""
+    if MERGE_TRIGGERS:
+        write_merged(infile, automations(parser, infile, inf), out, emitter)
+        return
+    if parallel:
+        compile_rules_parallel(parser, infile, inf, out, emitter, jobs,
+                               settings)
+        return
+    cache = None
+    if rule_cache and TRACE is None:
+        cache = RuleCache(infile, compiler_fingerprint(parser.options.parser,
+                                                       emitter))
+    compile_rules(parser, infile, inf, out, cache, emitter, profile)
+
+
+def convert_file(parser, infile, outfile, rule_cache=True, emitter='fast',
+                 profile=None, parallel=False, jobs=None, settings=None):
+    """Compile infile ("-" for stdin) to outfile ("-" for stdout), as
+    compile_stream() does."""
+    if infile == "-":
+        inf = sys.stdin
+        infile = "stdin"
+        rule_cache = False
+    else:
+        inf = open(infile, "r")
+    _LOGGER.debug("outfile = %s", outfile)
+
+    with inf:
+        write_output(outfile, lambda o: compile_stream(
+            parser, infile, inf, o, rule_cache, emitter, profile, parallel,
+            jobs, settings))
+
+
+def write_output(outfile, compile):
+    """Call compile(o) to write the automations of an automations file to
+    o, the stream of outfile ("-" for stdout), after its header."""
+    if outfile == "-":
+        compile(sys.stdout)
+        return
+
+    def compile_to(o):
+        o.write("## THIS FILE WAS GENERATED BY hass-hgl-to-yaml.py\n")
+        o.write("## " + " ".join(sys.argv) + "\n\n")
+        compile(o)
+
+    if os.path.exists(outfile) and not os.path.isfile(outfile):
+        # a device or pipe, e.g. /dev/null, is written in place
+        with open(outfile, "w") as o:
+            compile_to(o)
+        return
+    # write to a temporary file so that a compile error leaves the old
+    # output in place
+    tmp = "%s.tmp%d" % (outfile, os.getpid())
+    try:
+        with open(tmp, "w") as o:
+            compile_to(o)
+        os.replace(tmp, outfile)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_automations(path):
+    """The automations of a .yaml file: an automations file, or a package
+    with them under automation:."""
+    with open(path, "r") as f:
+        data = yaml.load(f, Loader=YAML_LOADER)
+    if isinstance(data, dict):
+        data = data.get('automation')
+    return data or []
+
+
+def automation_keys(automations):
+    """The automations by their ids, and for those with the same id as one
+    before them, how many of those there are."""
+    seen = collections.Counter()
+    keyed = {}
+    for a in automations:
+        keyed[(a.get('id'), seen[a.get('id')])] = a
+        seen[a.get('id')] += 1
+    return keyed
+
+
+def without_alias(automation):
+    return {k: v for (k, v) in automation.items() if k != 'alias'}
+
+
+def diff_automations(old, new):
+    """Compare the automations new with old by their ids, or else their
+    aliases: returns those of new with an id and an alias that none of old
+    has (added), those of old with an id and an alias that none of new has
+    (removed), those of new that differ from the one of old with the same
+    id (or, failing that, alias) besides their aliases (changed), as the
+    automations of rules that were edited do, and those that differ only
+    in their aliases (renamed), as the automations of rules that just
+    moved do."""
+    (before, after) = (automation_keys(old), automation_keys(new))
+    (added, changed, renamed) = ([], [], [])
+    for (k, a) in after.items():
+        if k not in before:
+            added.append(a)
+        elif before[k] != a:
+            if without_alias(before[k]) != without_alias(a):
+                changed.append(a)
+            else:
+                renamed.append(a)
+    removed = {}
+    for (k, a) in before.items():
+        if k not in after:
+            removed.setdefault(a.get('alias'), []).append(a)
+    for a in list(added):
+        if removed.get(a.get('alias')):
+            # the same automation, edited
+            removed[a.get('alias')].pop(0)
+            added.remove(a)
+            changed.append(a)
+    return (added, [a for same in removed.values() for a in same],
+            changed, renamed)
+
+
+def report_diff(diff, out):
+    """Write a line to out for each automation of diff, from
+    diff_automations(): + for those added, - removed, ~ changed and =
+    renamed."""
+    for (mark, automations) in zip("+-~=", diff):
+        for a in automations:
+            out.write("%s %s %s\n" % (mark, a.get('id'), a.get('alias')))
+
+
+def convert_diff(parser, infile, outfile, existing, delta=None,
+                 emitter='fast'):
+    """Compile infile to outfile as convert_file() does (but without a rule
+    cache), comparing its automations with those of existing, the .yaml
+    file of an earlier compile.  With delta, a file name ("-" for stdout),
+    the automations added and changed (not just renamed) since existing
+    are also written there.  Returns their diff_automations()."""
+    old = load_automations(existing)
+    with open(infile, "r") as f:
+        new = list(automations(parser, infile, f))
+    if MERGE_TRIGGERS:
+        new = merge_triggers(new)[0]
+    diff = diff_automations(old, new)
+    _LOGGER.info("%s: %d automations added, %d removed, %d changed and %d "
+                 "renamed since %s", infile, len(diff[0]), len(diff[1]),
+                 len(diff[2]), len(diff[3]), existing)
+
+    def writing(automations):
+        def compile(o):
+            writer = AutomationWriter(o, emitter)
+            for a in automations:
+                writer.write_automation(a)
+            writer.flush()
+        return compile
+    write_output(outfile, writing(new))
+    if delta:
+        written = set(map(id, diff[0] + diff[2]))
+        write_output(delta, writing([a for a in new if id(a) in written]))
+    return diff
+
+
+def automation_domain(automation):
+    """The domain of the service of the (first) action of automation, e.g.
+    light, or misc if it has none."""
+    action = automation.get('action')
+    if isinstance(action, list):
+        action = action[0] if action else None
+    service = action.get('service') if isinstance(action, dict) else None
+    if isinstance(service, str) and '.' in service:
+        return service.split('.', 1)[0]
+    return 'misc'
+
+
+# how --package-by groups the automations of a file into packages: by the
+# key of each automation (None for all of them)
+PACKAGE_GROUPS = {'file': lambda automation: None,
+                  'domain': automation_domain}
+
+
+def package_header(infile):
+    return "## THIS FILE WAS GENERATED BY hass-hgl-to-yaml.py FROM %s\n" % (
+        infile)
+
+
+def package_names(infiles):
+    """The name of the package of each of infiles: its path relative to
+    the directory all of them are in, without the suffix, e.g. lights_hall
+    for lights/hall.hgl."""
+    if not infiles:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) or "/"
+                               for f in infiles])
+    return {f: "_".join(Path(os.path.relpath(os.path.abspath(f), root))
+                        .with_suffix("").parts) for f in infiles}
+
+
+def write_if_changed(path, text):
+    """Atomically replace the file path with text, unless it already holds
+    exactly that; returns whether it was written."""
+    data = text.encode('utf8')
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return True
+
+
+def convert_packages(parser, infile, outdir, by='file', name=None,
+                     rule_cache=True, emitter='fast', profile=None,
+                     parallel=False, jobs=None, settings=None):
+    """Compile infile to Home Assistant packages in outdir: one named name
+    (by default the stem of infile) with all of its automations, or with
+    by='domain' one per domain of their actions, e.g. name_light.  Only the
+    packages whose contents changed are written, atomically, and those of
+    infile that it no longer generates are removed.  Returns how many were
+    written (or removed).  Packages by file compile as compile_stream()
+    does; the others are compiled rule by rule without a rule cache."""
+    name = name or Path(infile).stem
+    header = package_header(infile)
+    shards = {}
+    if by == 'file':
+        o = io.StringIO()
+        with open(infile, "r") as f:
+            compile_stream(parser, infile, f, o, rule_cache, emitter,
+                           profile, parallel, jobs, settings)
+        shards[name] = o.getvalue()
+    else:
+        group = PACKAGE_GROUPS[by]
+        writers = {}
+        with open(infile, "r") as f:
+            generated = automations(parser, infile, f)
+            if MERGE_TRIGGERS:
+                (generated, eliminated) = merge_triggers(generated)
+                _LOGGER.info("%s: merging triggers eliminated %d "
+                             "automations", infile, eliminated)
+            for automation in generated:
+                key = group(automation)
+                if key not in writers:
+                    writers[key] = AutomationWriter(io.StringIO(), emitter)
+                writers[key].write_automation(automation)
+        for (key, writer) in writers.items():
+            writer.flush()
+            shards["%s_%s" % (name, key)] = writer._out.getvalue()
+    os.makedirs(outdir, exist_ok=True)
+    written = 0
+    for (shard, body) in sorted(shards.items()):
+        text = header + ("automation:\n" + body if body else
+                         "automation: []\n")
+        written += write_if_changed(os.path.join(outdir, shard + ".yaml"),
+                                    text)
+    # packages of infile from an earlier compile that it no longer makes
+    removed = 0
+    for stale in sorted(Path(outdir).glob(name + "*.yaml")):
+        if stale.stem in shards:
+            continue
+        with open(stale, "r") as f:
+            if f.readline() != header:
+                continue
+        stale.unlink()
+        removed += 1
+    _LOGGER.info("%s: %d packages written, %d unchanged, %d removed",
+                 infile, written, len(shards) - written, removed)
+    return written + removed
+
+
+def check_parsers(input, infile, cache=True, emitter='fast'):
+    """Compile input with both the earley and the lalr parser and return
+    the unified diff of their YAML (empty when they are identical)."""
+    outputs = []
+    for engine in ('earley', 'lalr'):
+        parser = make_parser(engine, cache)
+        t = parse(parser, input)
+        o = AutomationWriter(None, emitter)
+        outputter = HassOutputter(infile, o, Source.from_text(input),
+                                  ModuleStore(parser), visit_tokens=True)
+        outputter.transform(t)
+        outputter.finish()
+        outputs.append(o.take().splitlines(keepends=True))
+    return list(difflib.unified_diff(outputs[0], outputs[1],
+                                     'earley', 'lalr'))
+
+
+def hgl_files(path, manifest=False):
+    """The .hgl files under the directory path, or listed one per line in
+    the manifest file path (blank lines and # comments are skipped)."""
+    if not manifest:
+        return sorted(str(p) for p in Path(path).rglob("*.hgl"))
+    base = Path(path).parent
+    files = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                files.append(str(base / line))
+    return files
+
+
+# each batch worker process builds (or loads) its parser once
+batch_parser = None
+batch_rule_cache = True
+batch_emitter = 'fast'
+batch_packages = None
+
+
+def batch_init(engine, cache, rule_cache, emitter, settings, packages=None):
+    global batch_parser, batch_rule_cache, batch_emitter, batch_packages
+    configure(**settings)
+    batch_parser = make_parser(engine, cache)
+    batch_rule_cache = rule_cache
+    batch_emitter = emitter
+    batch_packages = packages
+
+
+def batch_compile(infile):
+    """Compile infile to the .yaml beside it, or to its packages; returns
+    an error message, or None on success."""
+    try:
+        if batch_packages:
+            (outdir, by, names) = batch_packages
+            convert_packages(batch_parser, infile, outdir, by, names[infile],
+                             batch_rule_cache, batch_emitter)
+        else:
+            convert_file(batch_parser, infile,
+                         Path(infile).with_suffix(".yaml"), batch_rule_cache,
+                         batch_emitter)
+    except Exception as e:
+        return "%s: %s" % (infile, e)
+    return None
+
+
+def compile_batch(infiles, engine, cache, rule_cache, emitter, jobs=None,
+                  settings=None, packages=None):
+    """Compile infiles across a pool of jobs processes, which are
+    configure()d with settings; returns the number of files that failed.
+    With packages, an (outdir, by) pair, each file is compiled to its
+    packages in outdir, named after its path (see package_names()).  The
+    modules that infiles include are compiled first, here, once, and the
+    files that others of infiles include are not compiled on their own
+    (see top_level_files())."""
+    infiles = top_level_files(infiles, make_parser(engine, cache))
+    if packages:
+        packages = (*packages, package_names(infiles))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=batch_init,
+                             initargs=(engine, cache, rule_cache, emitter,
+                                       settings or {}, packages)) as pool:
+        errors = [e for e in pool.map(batch_compile, infiles) if e]
+    for e in errors:
+        _LOGGER.error("%s", e)
+    _LOGGER.info("compiled %d of %d files", len(infiles) - len(errors),
+                 len(infiles))
+    return len(errors)
+
+
+def file_stamp(path):
+    """The (modification time, size) of the file path, or None if it is
+    gone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def watch(targets, parser, rule_cache, emitter, debounce, packages=None):
+    """Recompile each of the .hgl files that targets() maps to their output
+    files whenever it or a file it includes changes (and has then been
+    left alone for debounce seconds), until interrupted.  A file that
+    another of them includes is compiled only into those including it.
+    With packages, an (outdir, by) pair, the output files are instead the
+    names of their packages in outdir."""
+    modules = ModuleStore(parser)
+    # the files that each target includes, however indirectly
+    included = {}
+    stamps = {}
+    pending = {}
+    while True:
+        now = time.monotonic()
+        current = targets()
+        for infile in current:
+            if infile not in included:
+                included[infile] = includes_of(modules, infile)
+        modules_of_others = set(
+            path for (infile, paths) in included.items()
+            if infile in current for path in paths)
+        for (infile, outfile) in current.items():
+            if os.path.abspath(infile) in modules_of_others:
+                continue
+            stamp = tuple(file_stamp(f) for f in [infile] + included[infile])
+            if stamp[0] is None:
+                continue
+            if stamps.get(infile) != stamp:
+                stamps[infile] = stamp
+                pending[infile] = (now, outfile)
+        for (infile, (changed, outfile)) in list(pending.items()):
+            if now - changed < debounce:
+                continue
+            del pending[infile]
+            try:
+                if packages:
+                    convert_packages(parser, infile, packages[0],
+                                     packages[1], outfile, rule_cache,
+                                     emitter)
+                else:
+                    convert_file(parser, infile, outfile, rule_cache,
+                                 emitter)
+                _LOGGER.info("compiled %s in %.0fms", infile,
+                             (time.monotonic() - now) * 1000)
+            except Exception as e:
+                _LOGGER.error("%s: %s", infile, e)
+            # its includes may have changed with it
+            included[infile] = includes_of(modules, infile)
+            stamps[infile] = tuple(file_stamp(f)
+                                   for f in [infile] + included[infile])
+        time.sleep(debounce / 4)
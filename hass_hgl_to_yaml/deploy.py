@@ -0,0 +1,309 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""Deploying compiled automations to Home Assistant.
+
+deploy() sends the automations that changed since they were last
+deployed to Home Assistant's config API (the one its automation editor
+uses), removes those that are no longer generated, and then reloads the
+automations once.  The requests share a pool of keep-alive HTTP/1.1
+connections (HTTPSession, on asyncio), at most jobs of them at a time,
+and a request that fails on the way (a lost connection, 429 or a 5xx) is
+retried.  What was deployed is recorded beside the grammar cache, by
+base URL, so an unchanged automation costs no request at all.
+"""
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import os
+import ssl
+import urllib.parse
+
+from .compiler import GRAMMAR_CACHE_DIR, load_automations
+
+__all__ = ['DeployError', 'HTTPSession', 'automation_id', 'load_automations',
+           'deploy', 'deploy_files']
+
+_LOGGER = logging.getLogger(__name__)
+
+# the requests that deploy() makes at a time, and how often it retries one
+DEPLOY_JOBS = 4
+DEPLOY_RETRIES = 3
+# seconds before the first retry of a request, doubling for each one after
+RETRY_DELAY = 0.5
+
+API_PATH = "/api/"
+CONFIG_PATH = "/api/config/automation/config/"
+RELOAD_PATH = "/api/services/automation/reload"
+
+
+class DeployError(Exception):
+    """A request that still failed after its retries."""
+
+
+class HTTPSession:
+    """A pool of at most limit keep-alive HTTP/1.1 connections to the
+    server of base_url, for asyncio.  Each request waits for a connection
+    of the pool, reusing an idle one where there is one."""
+
+    def __init__(self, base_url, headers=(), limit=DEPLOY_JOBS, timeout=30):
+        url = urllib.parse.urlsplit(base_url)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            raise ValueError("not an http(s) URL: %s" % base_url)
+        self._host = url.hostname
+        self._port = url.port or (443 if url.scheme == 'https' else 80)
+        self._ssl = (ssl.create_default_context() if url.scheme == 'https'
+                     else None)
+        self._prefix = url.path.rstrip('/')
+        self._headers = "".join("%s: %s\r\n" % h for h in (
+            ('Host', url.netloc), ('Content-Type', 'application/json'),
+            *headers))
+        self._timeout = timeout
+        self._slots = asyncio.Semaphore(limit)
+        self._idle = []
+        # how many connections were opened, and requests made on them
+        # (each retry included)
+        self.connections = 0
+        self.requests = 0
+
+    async def request(self, method, path, body=None):
+        """The (status, body) of the response to a request of path (under
+        the path of base_url) with body as JSON.  A request on an idle
+        connection that the server has since closed is made again on
+        another."""
+        data = b"" if body is None else json.dumps(body).encode('utf8')
+        message = ("%s %s%s HTTP/1.1\r\n%sContent-Length: %d\r\n\r\n" % (
+            method, self._prefix, path, self._headers, len(data))).encode(
+                'latin-1') + data
+        async with self._slots:
+            while True:
+                reused = bool(self._idle)
+                conn = self._idle.pop() if reused else await self._connect()
+                self.requests += 1
+                try:
+                    return await asyncio.wait_for(
+                        self._exchange(conn, message), self._timeout)
+                except (OSError, EOFError, ValueError):
+                    conn[1].close()
+                    if not reused:
+                        raise
+
+    async def _connect(self):
+        conn = await asyncio.wait_for(asyncio.open_connection(
+            self._host, self._port, ssl=self._ssl), self._timeout)
+        self.connections += 1
+        return conn
+
+    async def _exchange(self, conn, message):
+        (reader, writer) = conn
+        writer.write(message)
+        await writer.drain()
+        (version, status) = (await reader.readuntil(b"\r\n")).split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            (name, _, value) = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+        keep = (version == b"HTTP/1.1"
+                and headers.get('connection') != 'close')
+        if headers.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0],
+                           16)
+                chunks.append((await reader.readexactly(size + 2))[:-2])
+                if not size:
+                    break
+            body = b"".join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            # the body ends with the connection
+            body = await reader.read()
+            keep = False
+        if keep:
+            self._idle.append(conn)
+        else:
+            writer.close()
+        return (int(status), body)
+
+    async def close(self):
+        for (_, writer) in self._idle:
+            writer.close()
+        self._idle = []
+
+
+def automation_id(automation, seen=None):
+    """The id of automation in Home Assistant: its own id (which every
+    compiled automation has), or else one derived from its alias (and, with
+    seen, a Counter of the aliases before it, from how many of them have
+    the same alias)."""
+    if automation.get('id'):
+        return str(automation['id'])
+    alias = str(automation.get('alias'))
+    n = 0
+    if seen is not None:
+        n = seen[alias]
+        seen[alias] += 1
+    return "hgl_" + hashlib.sha256(
+        ("%s\0%d" % (alias, n)).encode('utf8')).hexdigest()[:16]
+
+
+def record_path(base_url):
+    key = hashlib.sha256(base_url.encode('utf8')).hexdigest()[:16]
+    return GRAMMAR_CACHE_DIR / "deploy" / ("%s.json" % key)
+
+
+def load_record(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_record(path, record):
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp%d" % os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        _LOGGER.warning("Not recording the deploy: %s", e)
+
+
+async def send(session, method, path, body, retries):
+    """The (status, body) of session.request(), retried with a growing
+    delay while it fails on the way to Home Assistant."""
+    delay = RETRY_DELAY
+    for attempt in range(retries + 1):
+        try:
+            (status, data) = await session.request(method, path, body)
+        except (OSError, EOFError, ValueError) as e:
+            error = e
+        else:
+            if status != 429 and status < 500:
+                return (status, data)
+            error = "HTTP %d" % status
+        if attempt < retries:
+            _LOGGER.debug("%s %s failed (%s), retrying", method, path, error)
+            await asyncio.sleep(delay)
+            delay *= 2
+    raise DeployError("%s %s: %s" % (method, path, error))
+
+
+async def deploy_async(groups, base_url, token, record, jobs, retries):
+    session = HTTPSession(base_url, [('Authorization', 'Bearer ' + token)],
+                          jobs)
+    counts = collections.Counter()
+
+    async def change(source, id, config, digest, kind):
+        path = CONFIG_PATH + urllib.parse.quote(id, safe="")
+        if config is None:
+            (status, data) = await send(session, 'DELETE', path, None,
+                                        retries)
+            # one already gone is just as removed
+            if status in (200, 404):
+                del record[source][id]
+                counts[kind] += 1
+                return
+        else:
+            (status, data) = await send(session, 'POST', path, config,
+                                        retries)
+            if status == 200:
+                record[source][id] = digest
+                counts[kind] += 1
+                return
+        raise DeployError("%s %s: HTTP %d %s" % (
+            config is None and 'DELETE' or 'POST', path, status,
+            data.decode('utf8', 'replace')))
+
+    currents = {}
+    for (source, automations) in groups.items():
+        current = currents[source] = {}
+        seen = collections.Counter()
+        for automation in automations:
+            current[automation_id(automation, seen)] = automation
+    generated = set().union(*currents.values())
+    changes = []
+    for (source, current) in currents.items():
+        deployed = record.setdefault(source, {})
+        for (id, automation) in current.items():
+            digest = hashlib.sha256(json.dumps(
+                automation, sort_keys=True).encode('utf8')).hexdigest()
+            if deployed.get(id) == digest:
+                counts['unchanged'] += 1
+            else:
+                changes.append((source, id, automation, digest,
+                                'changed' if id in deployed else 'added'))
+        for id in [id for id in deployed if id not in current]:
+            if id in generated:
+                # it moved to another source, which deploys it
+                del deployed[id]
+            else:
+                changes.append((source, id, None, None, 'removed'))
+    try:
+        if changes:
+            # so that a wrong URL or token fails once, not for each change
+            (status, data) = await send(session, 'GET', API_PATH, None,
+                                        retries)
+            if status != 200:
+                raise DeployError("GET %s: HTTP %d %s" % (
+                    API_PATH, status, data.decode('utf8', 'replace')))
+        for result in await asyncio.gather(*(change(*c) for c in changes),
+                                           return_exceptions=True):
+            if isinstance(result, Exception):
+                if not isinstance(result, DeployError):
+                    raise result
+                _LOGGER.error("%s", result)
+                counts['failed'] += 1
+        if counts['added'] or counts['changed'] or counts['removed']:
+            (status, data) = await send(session, 'POST', RELOAD_PATH, {},
+                                        retries)
+            if status != 200:
+                raise DeployError("POST %s: HTTP %d %s" % (
+                    RELOAD_PATH, status, data.decode('utf8', 'replace')))
+            counts['reloads'] += 1
+    finally:
+        await session.close()
+        counts['requests'] = session.requests
+        counts['connections'] = session.connections
+    return counts
+
+
+def deploy(groups, base_url, token, jobs=DEPLOY_JOBS, retries=DEPLOY_RETRIES,
+           record=None, within=None):
+    """Deploy groups, the automations (dicts) of each source (such as the
+    file they were compiled to), to the Home Assistant at base_url with
+    the long-lived access token, as the module docstring describes; the
+    automations that a source no longer has are removed.  record is the
+    file recording what was deployed (by default one per base_url beside
+    the grammar cache).  With within, a directory, the sources in it that
+    were deployed before but are not in groups have been removed, and so
+    are their automations.  Returns the Counter of the automations added,
+    changed, removed, unchanged and failed, and of the requests,
+    connections and reloads it took; raises DeployError if the reload
+    failed."""
+    record = record_path(base_url) if record is None else record
+    deployed = load_record(record)
+    if within is not None:
+        within = os.path.join(os.path.abspath(within), "")
+        groups = dict({s: [] for s in deployed if s.startswith(within)},
+                      **groups)
+    try:
+        return asyncio.run(deploy_async(groups, base_url, token, deployed,
+                                        jobs, retries))
+    finally:
+        save_record(record, {s: ids for (s, ids) in deployed.items() if ids})
+
+
+def deploy_files(paths, base_url, token, **kwargs):
+    """deploy() the automations of each of the .yaml files paths, with the
+    absolute path of each file as its source."""
+    return deploy({os.path.abspath(p): load_automations(p) for p in paths},
+                  base_url, token, **kwargs)
@@ -0,0 +1,333 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""The intermediate representation of compiled rules.
+
+HassOutputter transforms each rule into a Rule of the immutable nodes
+below, whose entity ids are tuples of entity ids, and automation_of(rule)
+emits that as the dict of a Home Assistant automation.  The nodes of a
+rule may be shared by the rules of its brace expansions (they are frozen,
+and copied with dataclasses.replace()), but each automation emitted is a
+new dict.
+"""
+
+import dataclasses
+import hashlib
+import json
+
+__all__ = ['Node', 'StateTrigger', 'MqttTrigger', 'EventTrigger',
+           'TimeTrigger', 'SunTrigger', 'TemplateTrigger', 'StateCondition',
+           'TemplateCondition', 'Conditions', 'ServiceAction', 'Delay',
+           'Rule', 'Braced', 'EntityRef', 'EntityState', 'GroupState',
+           'ConditionClause', 'ForClause', 'FromClause', 'ElseClause',
+           'automation_id', 'nth_automation_id', 'included_automation_id',
+           'automation_of', 'emit']
+
+
+class Node:
+    """A node of the IR: a frozen dataclass (made by @node) whose fields
+    are given by position or name (those not given are None)."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        # only the fields given, as most are None
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % (f.name, getattr(self, f.name))
+            for f in dataclasses.fields(self)
+            if getattr(self, f.name) is not None))
+
+
+def node(cls):
+    """cls, a subclass of Node, as a frozen dataclass with slots."""
+    return dataclasses.dataclass(frozen=True, slots=True, repr=False)(cls)
+
+
+# triggers
+
+@node
+class StateTrigger(Node):
+    entity_id: tuple = None
+    to: object = None
+    from_: object = None
+    for_: object = None
+
+
+@node
+class MqttTrigger(Node):
+    topic: str = None
+
+
+@node
+class EventTrigger(Node):
+    event_type: str = None
+
+
+@node
+class TimeTrigger(Node):
+    at: str = None
+
+
+@node
+class SunTrigger(Node):
+    event: str = None
+    offset: str = None
+
+
+@node
+class TemplateTrigger(Node):
+    value_template: str = None
+
+
+# conditions
+
+@node
+class StateCondition(Node):
+    entity_id: tuple = None
+    state: object = None
+    attribute: str = None
+    for_: object = None
+
+
+@node
+class TemplateCondition(Node):
+    value_template: str = None
+
+
+@node
+class Conditions(Node):
+    """All (connector 'and') or any ('or') of a tuple of conditions."""
+    connector: str = None
+    conditions: tuple = None
+
+
+# actions
+
+@node
+class ServiceAction(Node):
+    """A call of service; its entity ids are emitted as the comma-separated
+    string of .hgl, or as a list when listed."""
+    service: str = None
+    entity_id: tuple = None
+    data: dict = None
+    data_template: dict = None
+    listed: bool = None
+
+
+@node
+class Delay(Node):
+    delay: str = None
+
+
+@node
+class Rule(Node):
+    """An automation: its trigger, condition and action are each a node or
+    a tuple of them; alias is the name the rule was given, if any."""
+    name: str = None
+    trigger: object = None
+    condition: object = None
+    action: object = None
+    alias: str = None
+
+
+# the clauses of rules, before HassOutputter lowers them into the nodes
+# above
+
+@node
+class Braced(Node):
+    """A word whose braces expand into several, each replacing the * of
+    word; expansions is None when it had no braces."""
+    word: str = None
+    expansions: object = None
+
+
+@node
+class EntityRef(Node):
+    """The entity ids that an entity with braces expands into, with the
+    wildcard (the entity with a * for its braces) and the expansions of
+    the braces when it has them."""
+    entity_id: tuple = None
+    wildcard: str = None
+    expansions: object = None
+
+
+@node
+class EntityState(Node):
+    """entity is to (from from_), with the (attribute, value) pairs of
+    attributes."""
+    entity: EntityRef = None
+    to: object = None
+    from_: object = None
+    attributes: tuple = None
+
+
+@node
+class GroupState(Node):
+    """Any (connector 'or') or all ('and') of the entities of entity_id are
+    state."""
+    connector: str = None
+    entity_id: tuple = None
+    state: object = None
+
+
+@node
+class ConditionClause(Node):
+    """condition, after the keyword while (which also applies it to the
+    else of a rule) or when (which does not)."""
+    keyword: str = None
+    condition: object = None
+
+
+@node
+class ForClause(Node):
+    duration: object = None
+
+
+@node
+class FromClause(Node):
+    state: object = None
+
+
+@node
+class ElseClause(Node):
+    state: object = None
+    for_: object = None
+    action: ServiceAction = None
+
+
+# the emit stage
+
+def plain(value):
+    """value as YAML-ready data: a new dict for each dict, and a new list
+    for each tuple or list."""
+    if isinstance(value, dict):
+        return {k: plain(v) for (k, v) in value.items()}
+    if isinstance(value, (tuple, list)):
+        return [plain(v) for v in value]
+    return value
+
+
+def entity_ids(ids):
+    """ids as the entity_id of a trigger or condition: the one entity id,
+    or the list of several."""
+    return ids[0] if len(ids) == 1 else list(ids)
+
+
+def emit_state_trigger(t):
+    d = {'platform': 'state', 'entity_id': entity_ids(t.entity_id)}
+    if t.to is not None:
+        d['to'] = plain(t.to)
+    if t.from_ is not None:
+        d['from'] = plain(t.from_)
+    if t.for_ is not None:
+        d['for'] = plain(t.for_)
+    return d
+
+
+def emit_sun_trigger(t):
+    d = {'platform': 'sun', 'event': t.event}
+    if t.offset is not None:
+        d['offset'] = t.offset
+    return d
+
+
+def emit_state_condition(c):
+    d = {'condition': 'state', 'entity_id': entity_ids(c.entity_id)}
+    if c.attribute is not None:
+        d['attribute'] = c.attribute
+    d['state'] = plain(c.state)
+    if c.for_ is not None:
+        d['for'] = plain(c.for_)
+    return d
+
+
+def emit_service_action(a):
+    d = {'service': a.service}
+    if a.entity_id is not None:
+        d['entity_id'] = (list(a.entity_id) if a.listed
+                          else ",".join(a.entity_id))
+    if a.data is not None:
+        d['data'] = plain(a.data)
+    if a.data_template is not None:
+        d['data_template'] = plain(a.data_template)
+    return d
+
+
+EMITTERS = {
+    StateTrigger: emit_state_trigger,
+    MqttTrigger: lambda t: {'platform': 'mqtt', 'topic': t.topic},
+    EventTrigger: lambda t: {'platform': 'event',
+                             'event_type': t.event_type},
+    TimeTrigger: lambda t: {'platform': 'time', 'at': t.at},
+    SunTrigger: emit_sun_trigger,
+    TemplateTrigger: lambda t: {'platform': 'template',
+                                'value_template': t.value_template},
+    StateCondition: emit_state_condition,
+    TemplateCondition: lambda c: {'condition': 'template',
+                                  'value_template': c.value_template},
+    Conditions: lambda c: {'condition': c.connector,
+                           'conditions': emit(c.conditions)},
+    ServiceAction: emit_service_action,
+    Delay: lambda a: {'delay': a.delay},
+}
+
+
+def emit(node):
+    """The YAML-ready data of a trigger, condition or action node, or the
+    list of those of a tuple of them."""
+    if isinstance(node, tuple):
+        return [EMITTERS[type(n)](n) for n in node]
+    return EMITTERS[type(node)](node)
+
+
+# the content of an automation as automation_id() hashes it, whatever the
+# order of its keys
+CANONICAL_JSON = json.JSONEncoder(sort_keys=True, separators=(",", ":"),
+                                  default=str)
+
+
+def automation_id(trigger, condition, action, alias=None, name=None):
+    """The id of the automation named name with the (emitted) trigger,
+    condition and action of a rule given the alias (None if it had none):
+    a hash of them, so that it stays the same wherever the rule moves in
+    its file, or of the alias and name alone when the rule has an alias,
+    so that it also stays the same when the rule is changed."""
+    if alias is not None:
+        content = CANONICAL_JSON.encode([alias, name])
+    else:
+        content = CANONICAL_JSON.encode([trigger, condition, action, None])
+    return "hgl_" + hashlib.sha256(content.encode('utf8')).hexdigest()[:16]
+
+
+def nth_automation_id(id, n):
+    """The id of the nth (from 0) of the automations whose content has the
+    id id, as of identical rules: the first keeps id, and each after it
+    gets a hash of id and n, so that Home Assistant keeps them all."""
+    if not n:
+        return id
+    return "hgl_" + hashlib.sha256(
+        ("%s\0%d" % (id, n)).encode('utf8')).hexdigest()[:16]
+
+
+def included_automation_id(id, including):
+    """The id of the automation with the id id of an included file, in the
+    file including it (its path relative to the included file): a hash of
+    both, so that each file including the same file has automations with
+    ids of their own."""
+    return "hgl_" + hashlib.sha256(
+        ("%s\0%s" % (id, including)).encode('utf8')).hexdigest()[:16]
+
+
+def automation_of(rule):
+    """The Home Assistant automation of rule, as a new dict."""
+    trigger = emit(rule.trigger)
+    condition = None if rule.condition is None else emit(rule.condition)
+    action = emit(rule.action)
+    d = {'id': automation_id(trigger, condition, action, rule.alias,
+                             rule.name),
+         'alias': rule.name,
+         'initial_state': True,
+         'trigger': trigger}
+    if condition is not None:
+        d['condition'] = condition
+    d['action'] = action
+    return d
@@ -0,0 +1,149 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""A local stand-in for the parts of Home Assistant's API that deploying
+uses, to try --deploy (or deploy()) against without a Home Assistant:
+
+    python3 -m hass_hgl_to_yaml.standin [--port 8123] [--token TOKEN]
+    HASS_TOKEN=TOKEN hass-hgl-to-yaml.py rules.hgl rules.yaml \\
+        --deploy -b http://localhost:8123
+
+It keeps the automations in memory, answering on keep-alive HTTP/1.1
+connections, and counts the requests, connections and reloads it got;
+--fail answers the first requests with 503, as a busy server would.
+"""
+
+import argparse
+import json
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ['StandIn']
+
+_LOGGER = logging.getLogger(__name__)
+
+CONFIG_PATH = re.compile(r'/api/config/automation/config/([^/]+)$')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and body of a response are written separately
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        _LOGGER.debug(format, *args)
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b""
+        with server.lock:
+            server.requests += 1
+            if server.fail > 0:
+                server.fail -= 1
+                return self.respond(503, {'message': "Service unavailable"})
+        if (server.token is not None and self.headers.get('Authorization')
+                != "Bearer " + server.token):
+            return self.respond(401, {'message': "Unauthorized"})
+        if self.path == "/api/" and self.command == 'GET':
+            return self.respond(200, {'message': "API running."})
+        if (self.path == "/api/services/automation/reload"
+                and self.command == 'POST'):
+            with server.lock:
+                server.reloads += 1
+            return self.respond(200, [])
+        m = CONFIG_PATH.match(self.path)
+        if not m:
+            return self.respond(404, {'message': "Not found"})
+        id = m.group(1)
+        with server.lock:
+            if self.command == 'GET':
+                if id not in server.automations:
+                    return self.respond(404, {'message':
+                                              "Resource not found"})
+                return self.respond(200, server.automations[id])
+            if self.command == 'DELETE':
+                if server.automations.pop(id, None) is None:
+                    return self.respond(404, {'message':
+                                              "Resource not found"})
+                return self.respond(200, {'result': "ok"})
+            try:
+                config = json.loads(body)
+            except ValueError:
+                return self.respond(400, {'message': "Invalid JSON"})
+            if (not isinstance(config, dict) or 'trigger' not in config
+                    or 'action' not in config):
+                return self.respond(400, {'message': "Message malformed: "
+                                          "an automation needs a trigger "
+                                          "and an action"})
+            server.automations[id] = dict(config, id=id)
+            return self.respond(200, {'result': "ok"})
+
+    do_GET = do_POST = do_DELETE = handle_request
+
+
+class StandIn(ThreadingHTTPServer):
+    """The stand-in server, listening on address (port 0 for any free
+    one), which requires the token when one is given and answers the first
+    fail requests with 503."""
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), token=None, fail=0):
+        self.token = token
+        self.fail = fail
+        self.automations = {}
+        self.requests = 0
+        self.connections = 0
+        self.reloads = 0
+        self.lock = threading.Lock()
+        super().__init__(address, StandInHandler)
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address[:2]
+
+    def start(self):
+        """Serve on a thread of its own, returning self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        prog="python3 -m hass_hgl_to_yaml.standin",
+        description="Serve a stand-in for Home Assistant's automation "
+        "config API.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8123)
+    ap.add_argument("--token", help="require this bearer token")
+    ap.add_argument("--fail", type=int, default=0,
+                    help="answer the first FAIL requests with 503")
+    opts = ap.parse_args()
+    server = StandIn((opts.host, opts.port), opts.token, opts.fail)
+    print("Serving on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("%d automations; %d requests on %d connections, %d reloads" % (
+        len(server.automations), server.requests, server.connections,
+        server.reloads))
+
+
+if __name__ == '__main__':
+    main()
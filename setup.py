@@ -6,7 +6,7 @@ setup(
     name='pyvantage',
     version='0.0.1',
     license='MIT',
-    description='Grammar-based language for Home Assistant and converter to YAML.'
+    description='Grammar-based language for Home Assistant and converter to YAML.',
     author='Greg J. Badros',
     author_email='badros@gmail.com',
     url='http://github.com/gjbadros/hass-hgl-to-yaml',
@@ -18,6 +18,8 @@ setup(
         'Programming Language :: Python',
         'Topic :: Home Automation',
     ],
-    install_requires=[],
+    scripts=['hass-hgl-to-yaml.py'],
+    python_requires='>=3.10',
+    install_requires=['lark-parser', 'PyYAML', 'braceexpand'],
     zip_safe=True,
 )
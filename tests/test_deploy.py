@@ -0,0 +1,112 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""deploy() against the stand-in server, on a free port:
+
+    python3 -m unittest discover tests
+"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+from hass_hgl_to_yaml import deploy as hass_deploy
+from hass_hgl_to_yaml.deploy import DeployError, deploy
+from hass_hgl_to_yaml.standin import StandIn
+
+TOKEN = "secret"
+
+
+def automation(n, service='light.turn_on'):
+    return {'id': "hgl_test%d" % n,
+            'alias': "rule %d" % n,
+            'trigger': [{'platform': 'state', 'entity_id': 'sensor.x%d' % n,
+                         'to': 'on'}],
+            'action': {'service': service,
+                       'entity_id': 'light.l%d' % n}}
+
+
+class DeployTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.record = Path(self.dir.name) / "record.json"
+        self.servers = []
+        # no waiting between retries
+        self.delay = hass_deploy.RETRY_DELAY
+        hass_deploy.RETRY_DELAY = 0
+
+    def tearDown(self):
+        hass_deploy.RETRY_DELAY = self.delay
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.dir.cleanup()
+
+    def serve(self, **kwargs):
+        server = StandIn(token=TOKEN, **kwargs).start()
+        self.servers.append(server)
+        return server
+
+    def deploy(self, server, automations, **kwargs):
+        return deploy({'rules.yaml': automations}, server.url, TOKEN,
+                      record=self.record, **kwargs)
+
+    def test_deploy_then_unchanged(self):
+        server = self.serve()
+        counts = self.deploy(server, [automation(n) for n in range(10)])
+        self.assertEqual(counts['added'], 10)
+        self.assertEqual(counts['reloads'], 1)
+        self.assertEqual(sorted(server.automations),
+                         ["hgl_test%d" % n for n in range(10)])
+        # the probe, the automations and the reload
+        self.assertEqual(counts['requests'], 12)
+        self.assertEqual(counts['requests'], server.requests)
+        self.assertLessEqual(counts['connections'], 4)
+
+        counts = self.deploy(server, [automation(n) for n in range(10)])
+        self.assertEqual(counts['unchanged'], 10)
+        self.assertEqual(counts['requests'], 0)
+        self.assertEqual(server.requests, 12)
+        self.assertEqual(server.reloads, 1)
+
+    def test_changed_and_removed(self):
+        server = self.serve()
+        self.deploy(server, [automation(n) for n in range(3)])
+        counts = self.deploy(server, [automation(0),
+                                      automation(1, 'light.turn_off')])
+        self.assertEqual((counts['unchanged'], counts['changed'],
+                          counts['removed']), (1, 1, 1))
+        self.assertEqual(sorted(server.automations),
+                         ["hgl_test0", "hgl_test1"])
+        self.assertEqual(server.automations['hgl_test1']['action']['service'],
+                         'light.turn_off')
+        self.assertEqual(server.reloads, 2)
+
+    def test_retry_on_503(self):
+        server = self.serve(fail=3)
+        counts = self.deploy(server, [automation(n) for n in range(5)])
+        self.assertEqual(counts['added'], 5)
+        self.assertEqual(counts['failed'], 0)
+        self.assertEqual(len(server.automations), 5)
+        # the retries are counted too
+        self.assertEqual(counts['requests'], 7 + 3)
+        self.assertEqual(counts['requests'], server.requests)
+
+    def test_retries_exhausted(self):
+        server = self.serve(fail=100)
+        with self.assertRaises(DeployError):
+            self.deploy(server, [automation(0)], retries=2)
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(server.automations, {})
+
+    def test_wrong_token(self):
+        server = self.serve()
+        with self.assertRaises(DeployError):
+            deploy({'rules.yaml': [automation(0)]}, server.url, "wrong",
+                   record=self.record)
+        # only the probe was made
+        self.assertEqual(server.requests, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
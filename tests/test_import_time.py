@@ -0,0 +1,49 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""Importing hass_hgl_to_yaml, in a fresh interpreter, loads neither the
+parser nor the YAML modules, which only the first compile should load:
+
+    python3 -m unittest discover tests
+"""
+
+import json
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# modules that importing the package must not load
+HEAVY = ('hass_hgl_to_yaml.compiler', 'lark', 'yaml', 'braceexpand')
+
+PROBE = """
+import json, sys
+heavy = %r
+import hass_hgl_to_yaml
+print(json.dumps(sorted(
+    m for m in sys.modules
+    if m in heavy or m.startswith(tuple(h + '.' for h in heavy)))))
+""" % (HEAVY,)
+
+
+class ImportTest(unittest.TestCase):
+
+    def test_import_is_lazy(self):
+        loaded = json.loads(subprocess.run(
+            [sys.executable, "-c", PROBE], cwd=str(ROOT), capture_output=True,
+            text=True, check=True).stdout)
+        self.assertEqual(loaded, [], "importing hass_hgl_to_yaml loads "
+                         + ", ".join(loaded))
+
+    def test_compile_loads_them(self):
+        # so that the test above cannot pass by checking the wrong names
+        import hass_hgl_to_yaml as hgl
+        list(hgl.compile_string("when sensor.a is on do light.b\n",
+                                "a.hgl"))
+        self.assertIn('lark', sys.modules)
+        self.assertIn('hass_hgl_to_yaml.compiler', sys.modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
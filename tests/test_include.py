@@ -0,0 +1,109 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""include: the module cache, the ids of the rules of a file included in
+more than one, and cycles of includes:
+
+    python3 -m unittest discover tests
+"""
+
+import io
+import logging
+import tempfile
+import unittest
+from pathlib import Path
+
+import yaml
+from lark.exceptions import VisitError
+
+from hass_hgl_to_yaml import compiler
+from hass_hgl_to_yaml.compiler import (compile_stream, make_parser,
+                                       top_level_files)
+
+COMMON = """\
+TOPIC vantage/common
+when HALL_ON do script.hall_on
+
+hall powered_by switch.hall_amp
+"""
+
+
+class IncludeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_dir = compiler.GRAMMAR_CACHE_DIR
+        compiler.GRAMMAR_CACHE_DIR = Path(self.dir.name) / "cache"
+        compiler.compiled_modules.clear()
+        self.parser = make_parser('lalr', cache=False)
+        self.write("common.hgl", COMMON)
+        for name in ("a", "b"):
+            self.write("%s.hgl" % name,
+                       'include "common.hgl"\n\n'
+                       'when %s_ir is on do turn_on(light.%s)\n\n'
+                       '* off_at 23:45\n' % (name, name))
+
+    def tearDown(self):
+        compiler.GRAMMAR_CACHE_DIR = self.cache_dir
+        compiler.compiled_modules.clear()
+        self.dir.cleanup()
+
+    def write(self, name, text):
+        path = Path(self.dir.name) / name
+        path.write_text(text)
+        return str(path)
+
+    def compile(self, name):
+        """The YAML of the file name, and the modules compiled for it."""
+        path = str(Path(self.dir.name) / name)
+        out = io.StringIO()
+        with self.assertLogs(compiler._LOGGER, logging.INFO) as logs:
+            # (so that there is always a record)
+            compiler._LOGGER.info("compiling %s", path)
+            with open(path) as f:
+                compile_stream(self.parser, path, f, out, rule_cache=False)
+        compiled = [r.getMessage() for r in logs.records
+                    if r.getMessage().startswith("compiling the module")]
+        return (out.getvalue(), compiled)
+
+    def test_module_cached(self):
+        (first, compiled) = self.compile("a.hgl")
+        self.assertEqual(len(compiled), 1)
+        self.assertIn("script.hall_on", first)
+        self.assertIn("switch.hall_amp", first)
+        # from this process, then from the module cache on disk
+        self.assertEqual(self.compile("a.hgl"), (first, []))
+        compiler.compiled_modules.clear()
+        self.assertEqual(self.compile("a.hgl"), (first, []))
+        self.write("common.hgl", COMMON.replace("hall_on", "hall_lit"))
+        (edited, compiled) = self.compile("a.hgl")
+        self.assertEqual(len(compiled), 1)
+        self.assertIn("script.hall_lit", edited)
+
+    def test_ids_per_includer(self):
+        ids = []
+        for name in ("a.hgl", "b.hgl"):
+            (text, _) = self.compile(name)
+            ids.append({a['id'] for a in yaml.safe_load(text)
+                        if "hall_on" in str(a)})
+        self.assertEqual(len(ids[0]), 1)
+        self.assertEqual(len(ids[1]), 1)
+        self.assertNotEqual(ids[0], ids[1])
+
+    def test_top_level_files(self):
+        names = [str(Path(self.dir.name) / n)
+                 for n in ("a.hgl", "common.hgl", "b.hgl")]
+        self.assertEqual(top_level_files(names, self.parser),
+                         [names[0], names[2]])
+
+    def test_cycle(self):
+        self.write("common.hgl", COMMON + '\ninclude "a.hgl"\n')
+        with self.assertRaises(VisitError) as raised:
+            self.compile("a.hgl")
+        self.assertIsInstance(raised.exception.orig_exc, ValueError)
+        self.assertRegex(str(raised.exception.orig_exc),
+                         r"common.hgl:\d+: include cycle: .*a.hgl -> "
+                         r".*common.hgl -> .*a.hgl$")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""--parallel against the serial compile, on a fixture with TOPIC
+designations, unused rule names, rules spanning chunks and * off_at on the
+boundaries of the runs of rules that the processes compile:
+
+    python3 -m unittest discover tests
+"""
+
+import io
+import logging
+import re
+import tempfile
+import unittest
+from pathlib import Path
+
+from hass_hgl_to_yaml import compiler
+from hass_hgl_to_yaml.compiler import (MIN_PARALLEL_CHUNKS, compile_stream,
+                                       make_parser)
+
+# the chunks (rules) of the fixture, in turn
+RULES = ("when m_{0} is on do turn_on(light.l_{0})\n\n",
+         "when MSG_{0} do script.s_{0}\n\n",
+         "Rule {0}: when ev_{0} fires do foo.bar(light.x)\n\n",
+         "lamp_{0} powered_by switch.lamp_{0}\n\n")
+
+# and those on the boundaries of its runs: the last chunk of a run, or the
+# first of the next
+BOUNDARIES = {1: "Spanning:\n",
+              2: "Designated: TOPIC vantage/d\n\n",
+              3: "TOPIC vantage/e\n\n",
+              4: "* off_at 23:45\n\n",
+              5: "when m_1 is on do turn_on(light.l_1)\n\n",
+              6: "Spanning again:\n"}
+
+
+def fixture(runs):
+    """An .hgl file of runs runs of MIN_PARALLEL_CHUNKS chunks."""
+    chunks = []
+    for i in range(runs * MIN_PARALLEL_CHUNKS):
+        (run, n) = divmod(i + 1, MIN_PARALLEL_CHUNKS)
+        if n == 0 and run in BOUNDARIES:
+            chunks.append(BOUNDARIES[run])
+        else:
+            chunks.append(RULES[i % len(RULES)].format(i))
+    return "".join(chunks)
+
+
+class ParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_dir = compiler.GRAMMAR_CACHE_DIR
+        compiler.GRAMMAR_CACHE_DIR = Path(self.dir.name) / "cache"
+        compiler.compiled_modules.clear()
+        self.parser = make_parser('lalr', cache=False)
+
+    def tearDown(self):
+        compiler.GRAMMAR_CACHE_DIR = self.cache_dir
+        compiler.compiled_modules.clear()
+        self.dir.cleanup()
+
+    def compile(self, path, **kwargs):
+        out = io.StringIO()
+        with open(path) as f:
+            compile_stream(self.parser, path, f, out, rule_cache=False,
+                           **kwargs)
+        return out.getvalue()
+
+    def test_same_as_serial(self):
+        path = str(Path(self.dir.name) / "corpus.hgl")
+        Path(path).write_text(fixture(8))
+        serial = self.compile(path)
+        with self.assertLogs(compiler._LOGGER, logging.DEBUG) as logs:
+            parallel = self.compile(path, parallel=True, jobs=2)
+        self.assertEqual(parallel, serial)
+        # both the runs compiled in the workers and those compiled again
+        (recompiled, runs) = [
+            tuple(map(int, m.groups())) for m in (
+                re.search(r'(\d+) of (\d+) runs of rules recompiled',
+                          r.getMessage()) for r in logs.records) if m][0]
+        self.assertEqual(runs, 8)
+        self.assertGreater(recompiled, 0)
+        self.assertLess(recompiled, runs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""The lalr parser against the earley one (what --check-parsers does), on
+the examples of the README and on synthetic corpora:
+
+    python3 -m unittest discover tests
+"""
+
+import re
+import sys
+import unittest
+from pathlib import Path
+
+from lark.exceptions import UnexpectedInput
+
+from hass_hgl_to_yaml.compiler import check_parsers, make_parser, parse
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+import corpus  # noqa: E402
+
+CODE_BLOCK = re.compile(r'^```[^\n]*\n(.*?)^```', re.M | re.S)
+INCLUDE = re.compile(r'^include ', re.M)
+
+
+def readme_examples():
+    """The code blocks of the README that are rules: those the earley
+    parser, the original one, parses, but for the includes (of files
+    that are not here)."""
+    parser = make_parser('earley')
+    examples = []
+    for m in CODE_BLOCK.finditer((ROOT / "README.md").read_text()):
+        if INCLUDE.search(m.group(1)):
+            continue
+        try:
+            parse(parser, m.group(1))
+        except UnexpectedInput:
+            continue
+        examples.append(m.group(1))
+    return examples
+
+
+class ParsersTest(unittest.TestCase):
+
+    def assertAgree(self, text, name):
+        diff = check_parsers(text, name)
+        self.assertFalse(diff, "the parsers disagree on %s:\n%s" % (
+            name, "".join(diff)))
+
+    def test_readme_examples(self):
+        examples = readme_examples()
+        # so that a change to the README cannot leave nothing checked
+        self.assertGreaterEqual(len(examples), 3)
+        for (i, text) in enumerate(examples):
+            with self.subTest(example=i):
+                self.assertAgree(text, "readme%d.hgl" % i)
+
+    def test_corpora(self):
+        for (fanout, braced, seed) in ((1, 0, 0), (2, 0.5, 1), (3, 1, 2)):
+            text = "".join(corpus.generate(200, fanout, braced=braced,
+                                           seed=seed))
+            with self.subTest(fanout=fanout, braced=braced, seed=seed):
+                self.assertAgree(text, "corpus%d.hgl" % seed)
+
+
+if __name__ == '__main__':
+    unittest.main()
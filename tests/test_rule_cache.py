@@ -0,0 +1,121 @@
+# Copyright (C) 2019 Greg J. Badros <badros@gmail.com>
+# Distributed under the MIT License -- Use at your own risk!
+"""The rule cache: a file compiled again after an edit, with the YAML of
+its unchanged rules reused, against the same file compiled from scratch:
+
+    python3 -m unittest discover tests
+"""
+
+import io
+import tempfile
+import unittest
+from pathlib import Path
+
+from hass_hgl_to_yaml import compiler
+from hass_hgl_to_yaml.compiler import (RuleCache, compile_rules,
+                                       compiler_fingerprint, make_parser)
+
+RULES = """\
+# the rules of a house
+when {pantry,kitchen}_ir is Normal for 3 minutes do turn_off(light.mh_m_x)
+
+Kitchen Motion: when kitchen_ir or pantry_ir is Violated do turn_on(light.k)
+
+TOPIC vantage/other
+when VACUUM_CLEAN_{nook,kitchen} do script.vacuum_*
+
+garden_speaker powered_by switch.ph_b_wb_{o4_garden_4,o9_sw_garden_9}
+office powered_by switch.office_amp
+
+when x or y is on do foo else off do bar
+
+* off_at 23:45
+
+when ev2 fires do play_doorbird_media(a,b)
+"""
+
+
+class RuleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache_dir = compiler.GRAMMAR_CACHE_DIR
+        compiler.GRAMMAR_CACHE_DIR = Path(self.dir.name) / "cache"
+        compiler.compiled_modules.clear()
+        self.parser = make_parser('lalr', cache=False)
+        self.hgl = Path(self.dir.name) / "house.hgl"
+
+    def tearDown(self):
+        compiler.GRAMMAR_CACHE_DIR = self.cache_dir
+        compiler.compiled_modules.clear()
+        self.dir.cleanup()
+
+    def compile(self, text, cached=True):
+        """The YAML of text, compiled (with the rule cache, if cached) as
+        the file self.hgl, and the cache."""
+        self.hgl.write_text(text)
+        cache = None
+        if cached:
+            cache = RuleCache(str(self.hgl),
+                              compiler_fingerprint('lalr', 'fast'))
+        out = io.StringIO()
+        with open(self.hgl) as f:
+            compile_rules(self.parser, str(self.hgl), f, out, cache)
+        return (out.getvalue(), cache)
+
+    def assertRecompiled(self, text, edited):
+        """Compile text, then edited with the cache, and check the YAML is
+        that of edited compiled from scratch; returns the cache."""
+        self.compile(text)
+        (yaml, cache) = self.compile(edited)
+        (expected, _) = self.compile(edited, cached=False)
+        self.assertEqual(yaml, expected)
+        return cache
+
+    def test_unchanged(self):
+        (first, cache) = self.compile(RULES)
+        self.assertEqual(cache.hits, 0)
+        (second, cache) = self.compile(RULES)
+        self.assertEqual(second, first)
+        self.assertEqual(cache.misses, 0)
+
+    def test_lines_inserted(self):
+        # every rule is then on another line, but none needs compiling
+        # but the first, that the comments are part of
+        cache = self.assertRecompiled(RULES, RULES.replace(
+            "\n\nKitchen", "\n# a\n# b\n\nKitchen"))
+        self.assertEqual(cache.misses, 1)
+        self.assertGreater(cache.hits, 0)
+
+    def test_power_read(self):
+        # * off_at turns off the powered entities above it
+        cache = self.assertRecompiled(RULES, RULES.replace(
+            "switch.office_amp", "switch.office_receiver"))
+        self.assertEqual(cache.misses, 2)
+
+    def test_ids_current(self):
+        # a copy of a rule has an id of its own, which the one cached for
+        # the rule does not have
+        cache = self.assertRecompiled(RULES, RULES.replace(
+            "* off_at", "when x or y is on do foo else off do bar\n\n"
+            "* off_at"))
+        self.assertEqual(cache.misses, 1)
+
+    def test_topic(self):
+        self.assertRecompiled(RULES, RULES.replace("vantage/other",
+                                                   "vantage/vacuum"))
+
+    def test_modules_current(self):
+        common = Path(self.dir.name) / "common.hgl"
+        common.write_text("when y is on do bar\n")
+        text = 'include "common.hgl"\n\n' + RULES
+        self.compile(text)
+        common.write_text("when y is on do baz\n")
+        compiler.compiled_modules.clear()
+        (yaml, cache) = self.compile(text)
+        self.assertIn("baz", yaml)
+        self.assertEqual(cache.misses, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()